@@ -0,0 +1,51 @@
+'''Measure cache size and load time for compile tasks sharing most of their headers.
+
+Every entry records fingerprints of its source file and a set of headers drawn from a common pool, like translation units of one project.
+'''
+
+import pathlib
+import random
+import tempfile
+import time
+
+from erect.core import Fingerprint, SQLiteCache
+
+ENTRIES = 2000
+HEADERS = 1000
+HEADERS_PER_ENTRY = 300
+
+def fingerprint(i):
+    return Fingerprint(mtime_ns = 1_700_000_000_000_000_000 + i, hash = i.to_bytes(32, 'big'))
+
+def main():
+    rng = random.Random(0)
+    headers = [(pathlib.Path(f'include/subsystem{i % 20}/header{i}.h'), fingerprint(i)) for i in range(HEADERS)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = pathlib.Path(tmp) / 'cache.sqlite'
+
+        cache = SQLiteCache(filename)
+        for i in range(ENTRIES):
+            files = {pathlib.Path(f'src/{i}.cpp'): fingerprint(HEADERS + i)}
+            files.update(rng.sample(headers, HEADERS_PER_ENTRY))
+            cache[f'compile;build;src/{i}.cpp'] = {
+                'input_metadata': bytes(16),
+                'file_fingerprints': files,
+                'result': {'modules_required': [], 'modules_generated': []},
+                'duration': 1.0,
+            }
+        cache.compact()
+        cache.close()
+        size = filename.stat().st_size
+
+        start = time.monotonic()
+        cache = SQLiteCache(filename)
+        for i in range(ENTRIES):
+            cache[f'compile;build;src/{i}.cpp']
+        elapsed = time.monotonic() - start
+        cache.close()
+
+    print(f'{ENTRIES} entries with {HEADERS_PER_ENTRY} headers each: {size / 1024 / 1024:.1f} MB, loaded and decoded in {elapsed * 1000:.0f} ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+'''Compare FIFO and critical path scheduling on a synthetic graph.
+
+A chain of long tasks is requested after a batch of independent short tasks.
+With FIFO scheduling the chain starts last and runs serially at the end of the build.
+'''
+
+import asyncio
+import pathlib
+import tempfile
+import time
+
+from erect.core import Context, Task
+
+CHAIN_LENGTH = 6
+INDEPENDENT = 24
+DURATION = 0.1
+JOBS = 4
+
+class Sleep(Task):
+    def __new__(cls, ctx, name, dependencies = (), generation = 0):
+        self = super().__new__(cls, ctx, ('sleep', name))
+        self.dependencies.extend(dependencies)
+        self.generation = generation
+        return self
+
+    def input_metadata(self):
+        # Changes every build, so all tasks rerun.
+        return {'generation': self.generation}
+
+    async def run(self):
+        await asyncio.sleep(DURATION)
+
+def build(cache_file, generation, critical_path):
+    with Context(max_concurrent_tasks = JOBS, cache_file = cache_file, critical_path = critical_path) as ctx:
+        independent = [Sleep(ctx, f'independent{i}', generation = generation) for i in range(INDEPENDENT)]
+
+        chain = []
+        for i in range(CHAIN_LENGTH):
+            chain.append(Sleep(ctx, f'chain{i}', chain[-1:], generation = generation))
+
+        start = time.monotonic()
+        asyncio.run(ctx.run([*independent, chain[-1]]))
+        return time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_file = pathlib.Path(tmp) / 'cache.sqlite'
+
+        # First build records durations.
+        build(cache_file, 0, critical_path = False)
+
+        fifo = build(cache_file, 1, critical_path = False)
+        critical_path = build(cache_file, 2, critical_path = True)
+
+    print(f'FIFO:          {fifo:.2f} s')
+    print(f'Critical path: {critical_path:.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+'''Measure the per task overhead of the dependency engine.
+
+Tasks do no work and form a tree, each one depending on its parent, so the build time is spent scheduling.
+'''
+
+import asyncio
+import sys
+import time
+
+from erect.core import Context, Task
+
+TASKS = 100_000
+
+class Nop(Task):
+    def __new__(cls, ctx, i, dependencies):
+        self = super().__new__(cls, ctx, ('nop', i))
+        self.dependencies.extend(dependencies)
+        return self
+
+    async def run(self):
+        pass
+
+def main():
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else TASKS
+
+    with Context(max_concurrent_tasks = 8, cache_file = False) as ctx:
+        nodes = []
+        for i in range(tasks):
+            nodes.append(Nop(ctx, i, [nodes[(i - 1) // 2]] if i else []))
+
+        start = time.monotonic()
+        asyncio.run(ctx.run(nodes))
+        elapsed = time.monotonic() - start
+        overhead = ctx.engine.overhead
+
+    print(f'{tasks} tasks in {elapsed:.2f} s, {elapsed / tasks * 1e6:.1f} us/task')
+    print(f'Engine bookkeeping: {overhead:.2f} s, {overhead / tasks * 1e6:.1f} us/task')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''Measure module mapper throughput with concurrent clients speaking the GCC mapper protocol.
+
+Each client sends the requests of a compile that includes a batch of headers and exports a module, one block at a time, like g++ does.
+'''
+
+import asyncio
+import pathlib
+import tempfile
+import time
+
+from erect import Env
+from erect.core import Context
+from erect.lib.gcc.module_mapper import ModuleMapper
+
+CLIENTS = 32
+COMPILES = 200
+INCLUDES = 50
+
+def blocks(client, compile):
+    module = f'm{client}.{compile}'
+    return [
+        ['HELLO 1 GCC ident', 'MODULE-REPO'],
+        [f'INCLUDE-TRANSLATE include/header{i}.h' for i in range(INCLUDES)],
+        [f'MODULE-EXPORT {module}'],
+        [f'MODULE-COMPILED {module}'],
+    ]
+
+async def connect(mapper):
+    if getattr(mapper, 'socket_path', None) is not None:
+        return await asyncio.open_unix_connection(mapper.socket_path)
+    return await asyncio.open_connection('::1', mapper.port)
+
+async def client(mapper, i):
+    requests = 0
+    for compile in range(COMPILES):
+        reader, writer = await connect(mapper)
+        for block in blocks(i, compile):
+            writer.write((' ;\n'.join(block) + '\n').encode('utf-8'))
+            for _ in block:
+                await reader.readline()
+            requests += len(block)
+        writer.close()
+    return requests
+
+async def run(mapper):
+    await mapper.start()
+
+    start = time.monotonic()
+    requests = sum(await asyncio.gather(*(client(mapper, i) for i in range(CLIENTS))))
+    return requests, time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp, Context(cache_file = False) as ctx:
+        env = Env(ctx = ctx, build_dir = pathlib.Path(tmp))
+        mapper = ModuleMapper(env, pathlib.Path(tmp) / 'cmi')
+        requests, elapsed = asyncio.run(run(mapper))
+
+    print(f'{requests} requests from {CLIENTS} clients in {elapsed:.2f} s: {requests / elapsed:.0f} requests/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''Measure no-op build time of a large graph, with and without the clean subgraph pre-pass.
+
+Tasks form a binary tree, each one reading the output of its parent.
+'''
+
+import asyncio
+import pathlib
+import sys
+import tempfile
+import time
+
+from erect.core import Context, Task
+
+TASKS = 50_000
+
+class Write(Task):
+    def __new__(cls, ctx, root, i):
+        self = super().__new__(cls, ctx, ('write', i))
+        self.output = root / f'{i}.txt'
+        if i:
+            self.add_input_files(root / f'{(i - 1) // 2}.txt')
+        self.add_output_files(self.output)
+        return self
+
+    async def run(self):
+        self.output.write_text(self.id.str)
+
+def build(root, skip_clean):
+    with Context(max_concurrent_tasks = 8, cache_file = root / 'cache.sqlite', skip_clean = skip_clean) as ctx:
+        tasks = [Write(ctx, root, i) for i in range(TASKS)]
+
+        start = time.monotonic()
+        asyncio.run(ctx.run(tasks))
+        return time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp)
+
+        initial = build(root, skip_clean = True)
+        print(f'Initial build:         {initial:.2f} s', file = sys.stderr)
+
+        engine = build(root, skip_clean = False)
+        pre_pass = build(root, skip_clean = True)
+
+    print(f'No-op, engine only:    {engine:.2f} s ({engine / TASKS * 1e6:.1f} us/task)')
+    print(f'No-op, with pre-pass:  {pre_pass:.2f} s ({pre_pass / TASKS * 1e6:.1f} us/task)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''Measure compile throughput with a growing number of local worker daemons.
+
+Compiles go through a wrapper that sleeps before each compile, to stand in for compile time on a machine of its own.
+Preprocessing and linking run locally with one task slot.
+'''
+
+import asyncio
+import os
+import pathlib
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from erect import Env
+from erect.core import Context
+
+SOURCES = 32
+COMPILE_TIME = 0.25
+WORKERS = [0, 1, 2, 4, 8]
+
+WRAPPER = f'''#!/bin/sh
+case " $* " in
+    *" -c "*) sleep {COMPILE_TIME} ;;
+esac
+exec g++ "$@"
+'''
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'Worker on port {port} didn\'t start')
+
+def build(root, ports):
+    with Context(max_concurrent_tasks = 1, cache_file = False, remote_workers = [f'localhost:{port}' for port in ports]) as ctx:
+        env = Env(ctx = ctx, build_dir = root / f'build-{len(ports)}')
+        env.toolchain_prefix = f'{root}/slow-'
+        env.executable('bench', [pathlib.Path(f'src/{i}.cpp') for i in range(SOURCES)])
+
+        start = time.monotonic()
+        asyncio.run(ctx.run(ctx.tasks.values()))
+        return time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp)
+        os.chdir(root)
+
+        (root / 'src').mkdir()
+        for i in range(SOURCES):
+            (root / 'src' / f'{i}.cpp').write_text(f'int f{i}() {{ return {i}; }}\n' if i else 'int main() {}\n')
+
+        wrapper = root / 'slow-g++'
+        wrapper.write_text(WRAPPER)
+        wrapper.chmod(wrapper.stat().st_mode | stat.S_IXUSR)
+
+        for count in WORKERS:
+            ports = [free_port() for _ in range(count)]
+            daemons = [subprocess.Popen([sys.executable, '-m', 'erect.util.worker', '--port', str(port), '--jobs', '1']) for port in ports]
+            try:
+                for port in ports:
+                    wait_for(port)
+                elapsed = build(root, ports)
+            finally:
+                for daemon in daemons:
+                    daemon.terminate()
+                    daemon.wait()
+
+            print(f'{count} workers: {elapsed:.2f} s, {SOURCES / elapsed:.1f} compiles/s', flush = True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''Measure the overhead of tracing a build of many small tasks, and the size of the trace.
+
+Tasks form a binary tree, each one reading the output of its parent.
+'''
+
+import asyncio
+import json
+import pathlib
+import tempfile
+import time
+
+from erect.core import Context, Task
+
+TASKS = 100_000
+ROUNDS = 2
+
+class Write(Task):
+    def __new__(cls, ctx, root, i):
+        self = super().__new__(cls, ctx, ('write', i))
+        self.output = root / f'{i}.txt'
+        if i:
+            self.add_input_files(root / f'{(i - 1) // 2}.txt')
+        self.add_output_files(self.output)
+        return self
+
+    async def run(self):
+        self.output.write_text(self.id.str)
+
+def build(root, trace_file):
+    with Context(max_concurrent_tasks = 8, cache_file = False, trace_file = trace_file) as ctx:
+        tasks = [Write(ctx, root, i) for i in range(TASKS)]
+
+        start = time.monotonic()
+        asyncio.run(ctx.run(tasks))
+        return time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp)
+        trace_file = root / 'trace.json'
+
+        # Writing the task outputs is noisy, so alternate runs and take the best of each.
+        untraced = traced = float('inf')
+        for _ in range(ROUNDS):
+            untraced = min(untraced, build(root, trace_file = None))
+            traced = min(traced, build(root, trace_file = trace_file))
+
+        start = time.monotonic()
+        events = len(json.loads(trace_file.read_text()))
+        load = time.monotonic() - start
+        size = trace_file.stat().st_size
+
+    print(f'Untraced:  {untraced:.2f} s ({untraced / TASKS * 1e6:.1f} us/task)')
+    print(f'Traced:    {traced:.2f} s ({traced / TASKS * 1e6:.1f} us/task)')
+    print(f'Trace:     {events} events, {size / 1024 / 1024:.1f} MB, parsed in {load:.2f} s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+'''Measure clean build time of an executable with and without unity batches.
+
+Every source includes the same standard headers, so most of the compile time goes to parsing them.
+'''
+
+import asyncio
+import os
+import pathlib
+import tempfile
+import time
+
+from erect import Env
+from erect.core import Context
+
+SOURCES = 64
+UNITY = [None, 4, 16, 'directory']
+
+SOURCE = '''#include <map>
+#include <string>
+#include <vector>
+
+int f{i}() {{
+    std::map<std::string, std::vector<int>> m;
+    m["{i}"].push_back({i});
+    return m.size();
+}}
+'''
+
+def build(root, unity):
+    with Context(cache_file = False) as ctx:
+        env = Env(ctx = ctx, build_dir = root / f'build-{unity}')
+        env.executable('bench', [pathlib.Path('main.cpp'), *(pathlib.Path(f'src/{i}.cpp') for i in range(SOURCES))], unity = unity)
+
+        start = time.monotonic()
+        asyncio.run(ctx.run(ctx.tasks.values()))
+        return time.monotonic() - start
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = pathlib.Path(tmp)
+        os.chdir(root)
+
+        (root / 'src').mkdir()
+        for i in range(SOURCES):
+            (root / 'src' / f'{i}.cpp').write_text(SOURCE.format(i = i))
+        (root / 'main.cpp').write_text('int main() {}\n')
+
+        for unity in UNITY:
+            elapsed = build(root, unity)
+            print(f'unity = {unity!r}: {elapsed:.2f} s', flush = True)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
 from . import cli
 
-cli.main()
+# Guarded, since worker processes import the main module.
+if __name__ == '__main__':
+    cli.main()
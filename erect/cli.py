@@ -3,18 +3,46 @@ import asyncio
 import time
 import click
 
-from .core import Context
+from .core import Context, DeadlockError, hash_algorithms
 from .util.load import load_blueprint
 from .diagnostic.timeline import plot_timeline
 from .diagnostic.graph import render_graph
+from .diagnostic.stats import print_stats, print_top_tasks
+
+def _parse_pools(ctx, param, value):
+    pools = {}
+    for pool in value:
+        name, sep, limit = pool.partition('=')
+        if not sep or not limit.isdigit():
+            raise click.BadParameter(f'Expected NAME=LIMIT, got {pool!r}')
+        pools[name] = int(limit)
+    return pools
 
 @click.command()
 @click.argument('targets', nargs = -1, type = click.Path(readable = False, path_type = pathlib.Path))
-@click.option('-j', '--jobs', default = 1, help = 'Max parallel jobs.')
+@click.option('-t', '--task', 'task_prefixes', multiple = True, help = 'Build tasks with IDs starting with this prefix, e.g. "compile build/". May be repeated.')
+@click.option('-j', '--jobs', type = int, help = 'Max parallel jobs, defaults to 1, or the job count of a parent make.')
+@click.option('--jobserver/--no-jobserver', default = None, help = 'Provide a jobserver to child processes if there\'s no parent make\'s to use. By default only a parent make\'s jobserver is used.')
+@click.option('--pool', 'pools', multiple = True, callback = _parse_pools, help = 'NAME=LIMIT, run at most LIMIT tasks of a pool at once, e.g. link=2. May be repeated.')
+@click.option('--memory-budget', type = int, help = 'Don\'t start tasks beyond this estimated memory use (MB), as measured in their last run.')
+@click.option('--hash-jobs', type = int, help = 'Max parallel file stats and hashes, defaults to the number of CPUs.')
+@click.option('--hash', 'hash_algorithm', default = 'sha256', help = f'Hash algorithm used for file fingerprints: {", ".join(hash_algorithms())}, or one registered by the blueprint.')
 @click.option('--timeline', is_flag = True, help = 'Create a timeline plot after the build.')
+@click.option('--trace', type = click.Path(dir_okay = False, path_type = pathlib.Path), help = 'Write a Chrome trace of the build to this file while it runs, for viewing in Perfetto.')
 @click.option('--graph', is_flag = True, help = 'Create a render of the dependency graph after the build.')
 @click.option('--no-cache', is_flag = True, help = 'Don\'t use a cache file.')
-def main(targets = None, jobs = None, timeline = False, graph = False, no_cache = False):
+@click.option('--cache-max-size', type = int, help = 'Evict least recently used cache entries beyond this size (MB).')
+@click.option('--cache-gc', is_flag = True, help = 'Remove cache entries for tasks not in the blueprint, compact the cache and exit.')
+@click.option('--cache-keep-generations', default = 0, help = 'Keep cache entries used within this many builds on --cache-gc.')
+@click.option('--cache-compact', is_flag = True, help = 'Compact the cache and exit.')
+@click.option('--artifact-cache', type = click.Path(file_okay = False, path_type = pathlib.Path), envvar = 'ERECT_ARTIFACT_CACHE', help = 'Directory of a content addressed store to restore task outputs from.')
+@click.option('--artifact-cache-max-size', type = int, help = 'Evict least recently used artifacts beyond this size (MB).')
+@click.option('--remote-cache', envvar = 'ERECT_REMOTE_CACHE', help = 'URL of a remote artifact cache to fetch task outputs from and upload them to.')
+@click.option('--remote-cache-timeout', default = 10.0, help = 'Timeout in seconds for remote artifact cache requests.')
+@click.option('--remote-worker', 'remote_workers', multiple = True, envvar = 'ERECT_REMOTE_WORKERS', help = 'HOST:PORT of a worker daemon to run compiles on. May be repeated.')
+@click.option('--stats', is_flag = True, help = 'Print build statistics after the build.')
+@click.option('--top', 'top_tasks', type = int, help = 'Print the N tasks using the most CPU time, memory and block I/O in their last run.')
+def main(targets = None, task_prefixes = (), jobs = None, jobserver = None, pools = {}, memory_budget = None, hash_jobs = None, hash_algorithm = None, timeline = False, trace = None, graph = False, no_cache = False, cache_max_size = None, cache_gc = False, cache_keep_generations = 0, cache_compact = False, artifact_cache = None, artifact_cache_max_size = None, remote_cache = None, remote_cache_timeout = None, remote_workers = (), stats = False, top_tasks = None):
     main_start = time.monotonic()
 
     blueprint = pathlib.Path('blueprint.py')
@@ -22,23 +50,64 @@ def main(targets = None, jobs = None, timeline = False, graph = False, no_cache
 
     with Context(
         max_concurrent_tasks = jobs,
+        jobserver = jobserver,
+        pools = pools,
+        memory_budget = memory_budget,
+        max_hash_workers = hash_jobs,
+        hash_algorithm = hash_algorithm,
         cache_file = False if no_cache else None,
+        cache_max_size = cache_max_size and cache_max_size * 1024 * 1024,
+        artifact_cache = artifact_cache,
+        artifact_cache_max_size = artifact_cache_max_size and artifact_cache_max_size * 1024 * 1024,
+        remote_cache = remote_cache,
+        remote_cache_timeout = remote_cache_timeout,
+        remote_workers = remote_workers,
+        trace_file = trace,
     ) as ctx:
-        load_blueprint(blueprint)
+        if cache_compact:
+            ctx.cache.compact()
+            return
+
+        with ctx.trace('load blueprint', 'blueprint'):
+            load_blueprint(blueprint)
+
+        # Checked only now, since the blueprint may register more algorithms.
+        if hash_algorithm not in hash_algorithms():
+            raise click.BadParameter(f'{hash_algorithm!r} is not one of {", ".join(map(repr, hash_algorithms()))}.', param_hint = '--hash')
+
+        if cache_gc:
+            removed = ctx.cache.gc((id.mangled for id in ctx.tasks), keep_generations = cache_keep_generations)
+            ctx.cache.compact()
+            print(f'Removed {removed} cache entries.')
+            return
 
         run_start = time.monotonic()
 
         tasks = []
-        if targets:
+        if targets or task_prefixes:
             for target in targets:
-                target_files = [file for file in ctx.files.values() if file.path.is_relative_to(target)]
+                target_files = ctx.find_files(target)
                 assert target_files, f'No targets matching {target}'
                 tasks.extend(target_files)
-        
+
+            for prefix in task_prefixes:
+                target_tasks = ctx.find_tasks(prefix)
+                assert target_tasks, f'No tasks matching {prefix}'
+                tasks.extend(target_tasks)
+
         else:
             tasks = ctx.tasks.values()
 
-        asyncio.run(ctx.run(tasks))
+        try:
+            asyncio.run(ctx.run(tasks))
+        except DeadlockError as e:
+            raise click.ClickException(str(e))
+
+        if stats:
+            print_stats(ctx)
+
+        if top_tasks:
+            print_top_tasks(ctx, top_tasks)
 
         if timeline:
             plot_timeline(ctx, main_start, run_start)
@@ -1,4 +1,11 @@
+from .artifact import *
+from .cache import *
 from .context import *
 from .env import *
 from .file import *
+from .hash import *
+from .index import *
+from .scheduler import *
 from .task import *
+from .trace import *
+from .tracker import *
@@ -0,0 +1,342 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import http.client
+import io
+import json
+import os
+import pathlib
+import pickle
+import re
+import shutil
+import stat
+import tarfile
+import tempfile
+import urllib.error
+import urllib.request
+
+from .cache import metadata_digest
+
+__all__ = ['ArtifactStore', 'HTTPArtifactCache']
+
+_member_re = re.compile(r'manifest\.json|files/\d+')
+
+def _encode_result(value):
+    match value:
+        case pathlib.PurePath():
+            return {'path': str(value)}
+        case dict():
+            return {'dict': [[_encode_result(k), _encode_result(v)] for k, v in value.items()]}
+        case list() | tuple():
+            return {'list': [_encode_result(e) for e in value]}
+        case None | bool() | int() | float() | str():
+            return {'value': value}
+        case _:
+            raise TypeError(f'Can\'t store result of type {type(value).__name__}')
+
+def _decode_result(value):
+    match value:
+        case {'path': path}:
+            return pathlib.Path(path)
+        case {'dict': items}:
+            return {_decode_result(k): _decode_result(v) for k, v in items}
+        case {'list': items}:
+            return [_decode_result(e) for e in items]
+        case {'value': value}:
+            return value
+
+def _pack_entry(entry_dir):
+    'Pack an entry directory into an uncompressed tar archive.'
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj = buf, mode = 'w') as tar:
+        for path in sorted(entry_dir.rglob('*')):
+            if path.is_file():
+                tar.add(path, arcname = path.relative_to(entry_dir).as_posix())
+    return buf.getvalue()
+
+def _unpack_entry(data, entry_dir):
+    # Only regular files with names we'd have written ourselves are extracted.
+    with tarfile.open(fileobj = io.BytesIO(data), mode = 'r') as tar:
+        for member in tar:
+            if not member.isfile() or not _member_re.fullmatch(member.name):
+                raise ValueError(f'Unexpected artifact member {member.name!r}')
+
+            path = entry_dir / member.name
+            path.parent.mkdir(exist_ok = True)
+            with tar.extractfile(member) as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.chmod(path, member.mode & 0o555)
+
+def _create_entry(entry_dir, fill):
+    'Create `entry_dir` by calling `fill` on a temporary directory and moving it in place, so concurrent builds never see partial entries.'
+
+    if entry_dir.exists():
+        return
+
+    entry_dir.parent.mkdir(parents = True, exist_ok = True)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(prefix = '.tmp-', dir = entry_dir.parent))
+    try:
+        fill(tmp_dir)
+        tmp_dir.rename(entry_dir)
+    except (OSError, ValueError, tarfile.TarError):
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+class HTTPArtifactCache:
+    '''Remote artifact cache accessed by HTTP GET and PUT of `<url>/<key>`.
+
+    Requests run in a dedicated thread pool, and failing or timed out requests are treated as misses.
+    '''
+
+    def __init__(self, url, *, timeout = 10, max_connections = 8):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = max_connections,
+            thread_name_prefix = 'erect-remote',
+        )
+
+        self.errors = 0
+
+    def _get(self, key):
+        try:
+            with urllib.request.urlopen(f'{self.url}/{key}', timeout = self.timeout) as response:
+                return response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+
+    def _put(self, key, data):
+        request = urllib.request.Request(f'{self.url}/{key}', data = data, method = 'PUT')
+        with urllib.request.urlopen(request, timeout = self.timeout):
+            return True
+
+    async def _request(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(self.executor, func, *args), self.timeout)
+        except (OSError, http.client.HTTPException, asyncio.TimeoutError):
+            self.errors += 1
+            return None
+
+    async def get(self, key):
+        return await self._request(self._get, key)
+
+    async def put(self, key, data):
+        return await self._request(self._put, key, data)
+
+    def close(self):
+        self.executor.shutdown(wait = False, cancel_futures = True)
+
+class ArtifactStore:
+    '''Content addressed store of task outputs, shared between build directories and checkouts.
+
+    Entries are keyed by the task type, its input metadata, toolchain identity and the hashes of its declared input files.
+    Each entry is a directory holding a manifest and the output files.
+    The manifest also records the hashes of all input files seen by the task, including ones discovered while it ran, and a restore only happens if they all still match.
+
+    Paths under the task's artifact root (usually the build directory) are stored relative to it, so entries can be restored into other build directories.
+    Restored files are copied, since build directories modify outputs in place and must not write into the store.
+
+    If `remote` is set, local misses are looked up there and fetched into the store, and new entries are uploaded in the background.
+    '''
+
+    def __init__(self, ctx, root, max_size = None, remote = None):
+        self.ctx = ctx
+        self.root = pathlib.Path(root)
+        self.max_size = max_size
+        self.remote = remote
+        self._uploads = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.remote_hits = 0
+        self.uploads = 0
+
+    async def _submit(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.ctx.hash_executor, func, *args)
+
+    def _entry_dir(self, key):
+        return self.root / key[:2] / key
+
+    @staticmethod
+    def _encode_path(task, path):
+        root = task.artifact_root()
+        if root is not None and path.is_relative_to(root):
+            return [True, str(path.relative_to(root))]
+        return [False, str(path)]
+
+    @staticmethod
+    def _decode_path(task, path):
+        'Decode a path from a manifest, or return None if a relative one would escape the artifact root.'
+
+        relative, path = path
+        if relative:
+            root = task.artifact_root()
+            path = pathlib.PurePath(path)
+            if root is None or path.is_absolute() or '..' in path.parts:
+                return None
+            return root / path
+        return pathlib.Path(path)
+
+    async def key(self, task):
+        fingerprints = self.ctx.fingerprints
+        hashes = await asyncio.gather(*(fingerprints.hash(f.path) for f in task._input_files))
+
+        key = pickle.dumps((
+            type(task).__module__,
+            type(task).__qualname__,
+            metadata_digest(task.input_metadata()),
+            task.toolchain_identity(),
+            fingerprints.algorithm,
+            [(self._encode_path(task, f.path), h) for f, h in zip(task._input_files, hashes)],
+        ), protocol = 5)
+
+        return hashlib.blake2b(key, digest_size = 20).hexdigest()
+
+    async def restore(self, task, key):
+        'Restore outputs and result of `task` from the store. Returns True on a hit.'
+
+        entry_dir = self._entry_dir(key)
+
+        manifest = await self._load_manifest(entry_dir)
+
+        if manifest is None and self.remote is not None:
+            data = await self.remote.get(key)
+
+            if data is not None:
+                await self._submit(_create_entry, entry_dir, lambda tmp_dir: _unpack_entry(data, tmp_dir))
+                manifest = await self._load_manifest(entry_dir)
+                if manifest is not None:
+                    self.remote_hits += 1
+
+        if manifest is None:
+            self.misses += 1
+            return False
+
+        # All inputs the task saw when the entry was stored must be unchanged.
+        fingerprints = self.ctx.fingerprints
+        inputs = [self._decode_path(task, path) for path, _ in manifest['inputs']]
+        if None in inputs:
+            self.misses += 1
+            return False
+        for path, (_, digest) in zip(inputs, manifest['inputs']):
+            if await fingerprints.stat(path) is None or (await fingerprints.hash(path)).hex() != digest:
+                self.misses += 1
+                return False
+
+        # Entries may come from a remote cache, so outputs are only written where the task itself would write them.
+        outputs = [self._decode_path(task, path) for path in manifest['outputs']]
+        if not all(path is not None and task.artifact_restorable(path) for path in outputs):
+            self.misses += 1
+            return False
+
+        await self._submit(self._restore_files, entry_dir, outputs)
+        for path in outputs:
+            fingerprints.invalidate(path)
+
+        known_inputs = {f.path for f in task._input_files}
+        known_outputs = {f.path for f in task._output_files}
+        task.add_input_files(*(path for path in inputs if path not in known_inputs))
+        task.add_output_files(*(path for path in outputs if path not in known_outputs))
+        task.result = _decode_result(manifest['result'])
+
+        self.hits += 1
+        return True
+
+    async def _load_manifest(self, entry_dir):
+        try:
+            return json.loads(await self._submit((entry_dir / 'manifest.json').read_bytes))
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _restore_files(entry_dir, outputs):
+        for i, path in enumerate(outputs):
+            path.parent.mkdir(parents = True, exist_ok = True)
+            path.unlink(missing_ok = True)
+            shutil.copy(entry_dir / 'files' / str(i), path)
+            os.chmod(path, stat.S_IMODE(path.stat().st_mode) | stat.S_IWUSR)
+
+        # Mark entry as recently used.
+        os.utime(entry_dir)
+
+    async def store(self, task, key):
+        try:
+            result = _encode_result(task.result)
+        except TypeError:
+            return
+
+        fingerprints = self.ctx.fingerprints
+        hashes = await asyncio.gather(*(fingerprints.hash(f.path) for f in task._input_files))
+        outputs = task.artifact_outputs()
+
+        manifest = {
+            'result': result,
+            'inputs': [[self._encode_path(task, f.path), h.hex()] for f, h in zip(task._input_files, hashes)],
+            'outputs': [self._encode_path(task, path) for path in outputs],
+        }
+
+        entry_dir = self._entry_dir(key)
+        await self._submit(_create_entry, entry_dir, lambda tmp_dir: self._store_files(tmp_dir, manifest, outputs))
+        self.stores += 1
+
+        if self.remote is not None:
+            upload = asyncio.create_task(self._upload(key, entry_dir))
+            self._uploads.add(upload)
+            upload.add_done_callback(self._uploads.discard)
+
+    @staticmethod
+    def _store_files(entry_dir, manifest, outputs):
+        (entry_dir / 'files').mkdir()
+
+        # Stored files are made read-only, so nothing modifies an entry once it's in the store.
+        for i, path in enumerate(outputs):
+            shutil.copy(path, entry_dir / 'files' / str(i))
+            os.chmod(entry_dir / 'files' / str(i), stat.S_IMODE(path.stat().st_mode) & ~0o222)
+
+        (entry_dir / 'manifest.json').write_text(json.dumps(manifest))
+
+    async def _upload(self, key, entry_dir):
+        data = await self._submit(_pack_entry, entry_dir)
+        if await self.remote.put(key, data):
+            self.uploads += 1
+
+    async def finish(self):
+        'Wait for pending uploads and apply the size limit.'
+
+        await asyncio.gather(*self._uploads)
+        await self._submit(self.evict)
+
+    def close(self):
+        if self.remote is not None:
+            self.remote.close()
+
+    def evict(self):
+        'Remove least recently used entries until the store fits in `max_size` bytes.'
+
+        if self.max_size is None or not self.root.exists():
+            return
+
+        entries = []
+        for entry_dir in self.root.glob('*/*'):
+            # Skip entries still being assembled.
+            if entry_dir.name.startswith('.'):
+                continue
+
+            size = sum(f.stat().st_size for f in entry_dir.rglob('*') if f.is_file())
+            entries.append((entry_dir.stat().st_mtime_ns, size, entry_dir))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors = True)
+            total -= size
+
+            try:
+                entry_dir.parent.rmdir()
+            except OSError:
+                pass
@@ -0,0 +1,388 @@
+import hashlib
+import json
+import os
+import pathlib
+import pickle
+import sqlite3
+import time
+
+from .file import Fingerprint
+
+__all__ = ['Cache', 'MemoryCache', 'SQLiteCache', 'metadata_digest']
+
+def _canonical(value):
+    '''Encode `value` so that equal metadata always gives equal output.
+
+    Pickle doesn't: sets are written in hash order, which changes between processes for strings, and repeated objects are memoized by identity.
+    '''
+
+    match value:
+        case pathlib.PurePath():
+            return {'path': str(value)}
+        case dict():
+            return {'dict': sorted(([_canonical(k), _canonical(v)] for k, v in value.items()), key = _dumps)}
+        case set() | frozenset():
+            return {'set': sorted((_canonical(e) for e in value), key = _dumps)}
+        case list() | tuple():
+            return {'list': [_canonical(e) for e in value]}
+        case None | bool() | int() | float() | str():
+            return {'value': value}
+        case bytes():
+            return {'bytes': value.hex()}
+        case _:
+            # Other objects are left to pickle, and are only canonical if their state is.
+            return {'pickle': pickle.dumps(value, protocol = 5).hex()}
+
+def _dumps(value):
+    return json.dumps(value, separators = (',', ':'))
+
+def metadata_digest(metadata):
+    'Compact digest of a task\'s input metadata, stored in place of the metadata itself.'
+
+    return hashlib.blake2b(_dumps(_canonical(metadata)).encode('utf-8'), digest_size = 16).digest()
+
+class Cache:
+    '''Maps mangled task IDs to cache entries.
+
+    Writes may be buffered until `flush()`, which is called once at the end of a build.
+    '''
+
+    load_time = 0.0
+    'Seconds spent opening and loading the cache.'
+
+    def __contains__(self, key):
+        raise NotImplementedError()
+
+    def __getitem__(self, key):
+        raise NotImplementedError()
+
+    def __setitem__(self, key, entry):
+        raise NotImplementedError()
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def size(self):
+        'Size of the cache in bytes.'
+
+        return 0
+
+    def gc(self, keep, keep_generations = 0):
+        '''Remove entries whose keys are not in `keep`.
+
+        Entries used since the cache was opened, or within the last `keep_generations` builds before that, are kept regardless.
+        Returns the number of removed entries.
+        '''
+
+        return 0
+
+    def compact(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class MemoryCache(Cache):
+    def __init__(self):
+        self._entries = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __getitem__(self, key):
+        return self._entries[key]
+
+    def __setitem__(self, key, entry):
+        self._entries[key] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def gc(self, keep, keep_generations = 0):
+        stale = self._entries.keys() - set(keep)
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+class SQLiteCache(Cache):
+    '''Cache stored in an SQLite database.
+
+    All rows are read in a single query when opened, but only unpickled when accessed.
+    The database is in WAL mode, so other processes can read it while a build is writing to it.
+
+    Each opening of the cache is a generation, and every entry records the last generation that used it.
+    If `max_size` is set, the least recently used entries are evicted on flush until the entries fit in `max_size` bytes.
+
+    File fingerprints are interned in a table of their own, and entries refer to them by ID.
+    Headers included by many compile tasks are then stored once, rather than once per task.
+    Fingerprints no entry refers to any more are removed on flush, once enough new ones were added since they were last removed, and whenever entries are evicted.
+    Their size counts towards `max_size`.
+
+    Several processes may use the cache at once, so fingerprint IDs are never reused, and flushes hold the write lock while they check that the fingerprints they refer to still exist.
+    Entries referring to fingerprints that another process removed are treated as missing.
+    '''
+
+    def __init__(self, filename, max_size = None):
+        start = time.monotonic()
+
+        self.filename = filename
+        self.max_size = max_size
+        self.db = sqlite3.connect(filename, timeout = 60)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, entry BLOB NOT NULL, generation INTEGER NOT NULL DEFAULT 0)')
+            if 'generation' not in (name for _, name, *_ in self.db.execute('PRAGMA table_info(tasks)')):
+                self.db.execute('ALTER TABLE tasks ADD COLUMN generation INTEGER NOT NULL DEFAULT 0')
+            self._create_fingerprints_table()
+            self.db.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (\'generation\', 0)')
+            self.db.execute('INSERT OR IGNORE INTO meta (key, value) VALUES (\'fingerprints_added\', 0)')
+            self.db.execute('UPDATE meta SET value = value + 1 WHERE key = \'generation\'')
+            self.generation, = self.db.execute('SELECT value FROM meta WHERE key = \'generation\'').fetchone()
+
+        self._raw = dict(self.db.execute('SELECT id, entry FROM tasks'))
+        self._entries = {}
+
+        # Fingerprint rows are only turned into objects when an entry referring to them is accessed.
+        self._fingerprint_rows = {row[0]: row[1:] for row in self.db.execute('SELECT id, path, mtime_ns, hash, algorithm FROM fingerprints')}
+        self._fingerprint_ids = {row: id for id, row in self._fingerprint_rows.items()}
+        self._fingerprints = {}
+        self._paths = {}
+        self._fingerprints_added = 0
+
+        self._dirty = set()
+        self._used = set()
+
+        self.load_time = time.monotonic() - start
+
+    def _create_fingerprints_table(self):
+        schema = 'CREATE TABLE fingerprints (id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, mtime_ns INTEGER NOT NULL, hash BLOB NOT NULL, algorithm TEXT NOT NULL, UNIQUE (path, mtime_ns, hash, algorithm))'
+
+        existing = self.db.execute('SELECT sql FROM sqlite_master WHERE type = \'table\' AND name = \'fingerprints\'').fetchone()
+        if existing is None:
+            self.db.execute(schema)
+        elif existing[0] != schema:
+            # Caches from before IDs were unique and never reused. Duplicate rows are dropped, and entries referring to them become misses.
+            self.db.execute('ALTER TABLE fingerprints RENAME TO old_fingerprints')
+            self.db.execute(schema)
+            self.db.execute('INSERT INTO fingerprints SELECT min(id), path, mtime_ns, hash, algorithm FROM old_fingerprints GROUP BY path, mtime_ns, hash, algorithm')
+            self.db.execute('DROP TABLE old_fingerprints')
+
+    def __contains__(self, key):
+        if key in self._raw:
+            entry = self._decode(self._raw.pop(key))
+            if entry is None:
+                return False
+            self._entries[key] = entry
+
+        return key in self._entries
+
+    def _fingerprint(self, id):
+        'The path and fingerprint with ID `id`, or None if another process removed it.'
+
+        if id not in self._fingerprints:
+            if id not in self._fingerprint_rows:
+                row = self.db.execute('SELECT path, mtime_ns, hash, algorithm FROM fingerprints WHERE id = ?', (id,)).fetchone()
+                if row is None:
+                    return None
+                self._fingerprint_rows[id] = row
+                self._fingerprint_ids[row] = id
+
+            path, mtime_ns, hash, algorithm = self._fingerprint_rows[id]
+            if path not in self._paths:
+                self._paths[path] = pathlib.Path(path)
+            self._fingerprints[id] = (self._paths[path], Fingerprint(mtime_ns, hash, algorithm))
+
+        return self._fingerprints[id]
+
+    def _fingerprint_id(self, path, fingerprint):
+        row = (str(path), fingerprint.mtime_ns, fingerprint.hash, fingerprint.algorithm)
+        if row not in self._fingerprint_ids:
+            # Another process may have added the same row since the cache was opened.
+            if self.db.execute('INSERT OR IGNORE INTO fingerprints (path, mtime_ns, hash, algorithm) VALUES (?, ?, ?, ?)', row).rowcount:
+                self._fingerprints_added += 1
+            id, = self.db.execute('SELECT id FROM fingerprints WHERE path = ? AND mtime_ns = ? AND hash = ? AND algorithm = ?', row).fetchone()
+            self._fingerprint_rows[id] = row
+            self._fingerprint_ids[row] = id
+
+        return self._fingerprint_ids[row]
+
+    def _forget_fingerprints(self, ids):
+        for id in ids:
+            row = self._fingerprint_rows.pop(id, None)
+            if row is not None:
+                self._fingerprint_ids.pop(row, None)
+            self._fingerprints.pop(id, None)
+
+    def _check_fingerprints(self):
+        '''Forget known fingerprints that dirty entries refer to but another process has since removed, so they are added again.
+
+        Must be called holding the write lock.
+        '''
+
+        rows = {
+            (str(path), fingerprint.mtime_ns, fingerprint.hash, fingerprint.algorithm)
+            for key in self._dirty
+            for path, fingerprint in self._entries[key].get('file_fingerprints', {}).items()
+        }
+        ids = [self._fingerprint_ids[row] for row in rows if row in self._fingerprint_ids]
+
+        existing = set()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            existing.update(id for id, in self.db.execute(f'SELECT id FROM fingerprints WHERE id IN ({", ".join("?" * len(chunk))})', chunk))
+        self._forget_fingerprints(set(ids) - existing)
+
+    def _decode(self, data):
+        'Decode an entry, or return None if it refers to fingerprints that were removed.'
+
+        entry = pickle.loads(data)
+        if 'file_fingerprint_ids' in entry:
+            fingerprints = [self._fingerprint(id) for id in entry.pop('file_fingerprint_ids')]
+            if None in fingerprints:
+                return None
+            entry['file_fingerprints'] = dict(fingerprints)
+        return entry
+
+    def _encode(self, entry):
+        if 'file_fingerprints' in entry:
+            entry = entry.copy()
+            entry['file_fingerprint_ids'] = [self._fingerprint_id(path, fingerprint) for path, fingerprint in entry.pop('file_fingerprints').items()]
+        return pickle.dumps(entry, protocol = 5)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._used.add(key)
+        return self._entries[key]
+
+    def __setitem__(self, key, entry):
+        self._raw.pop(key, None)
+        self._entries[key] = entry
+        self._dirty.add(key)
+
+    def __len__(self):
+        return len(self._entries) + len(self._raw)
+
+    def _forget(self, keys):
+        for key in keys:
+            self._raw.pop(key, None)
+            self._entries.pop(key, None)
+            self._dirty.discard(key)
+            self._used.discard(key)
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in [self.filename, f'{self.filename}-wal'] if os.path.exists(f))
+
+    def gc(self, keep, keep_generations = 0):
+        self.flush()
+
+        with self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('CREATE TEMP TABLE keep (id TEXT PRIMARY KEY)')
+            self.db.executemany('INSERT OR IGNORE INTO keep (id) VALUES (?)', ((key,) for key in keep))
+            stale = [key for key, in self.db.execute(
+                'SELECT id FROM tasks WHERE id NOT IN (SELECT id FROM keep) AND generation < ?',
+                (self.generation - keep_generations,),
+            )]
+            self.db.executemany('DELETE FROM tasks WHERE id = ?', ((key,) for key in stale))
+            self.db.execute('DROP TABLE keep')
+
+            self._forget(stale)
+            self._remove_unreferenced_fingerprints()
+
+        return len(stale)
+
+    def compact(self):
+        self.flush()
+        self.db.execute('VACUUM')
+        self.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def _fingerprint_sizes(self):
+        'Approximate size of each fingerprint row in bytes, by ID.'
+
+        return dict(self.db.execute('SELECT id, length(CAST(path AS BLOB)) + length(hash) + length(algorithm) + 16 FROM fingerprints'))
+
+    def _remove_unreferenced_fingerprints(self, referenced = None):
+        '''Remove fingerprints that aren't in `referenced`, or referred to by any entry if None.
+
+        Must be called holding the write lock with all entries written, so no other process refers to a fingerprint meanwhile.
+        '''
+
+        if referenced is None:
+            referenced = set()
+            for data, in self.db.execute('SELECT entry FROM tasks'):
+                referenced.update(pickle.loads(data).get('file_fingerprint_ids', ()))
+
+        unreferenced = {id for id, in self.db.execute('SELECT id FROM fingerprints')} - referenced
+        self.db.executemany('DELETE FROM fingerprints WHERE id = ?', ((id,) for id in unreferenced))
+        self._forget_fingerprints(unreferenced)
+
+        self.db.execute('UPDATE meta SET value = 0 WHERE key = \'fingerprints_added\'')
+
+    def _evict(self):
+        sizes = self._fingerprint_sizes()
+        entries_size, = self.db.execute('SELECT coalesce(sum(length(entry)), 0) FROM tasks').fetchone()
+        if entries_size + sum(sizes.values()) <= self.max_size:
+            return False
+
+        # Each entry is charged for the fingerprints no more recently used entry refers to.
+        total = 0
+        evicted = []
+        referenced = set()
+        for key, data in self.db.execute('SELECT id, entry FROM tasks ORDER BY generation DESC'):
+            ids = set(pickle.loads(data).get('file_fingerprint_ids', ())) - referenced
+            total += len(data) + sum(sizes.get(id, 0) for id in ids)
+            if total > self.max_size:
+                evicted.append(key)
+            else:
+                referenced |= ids
+
+        self.db.executemany('DELETE FROM tasks WHERE id = ?', ((key,) for key in evicted))
+        self._forget(evicted)
+        self._remove_unreferenced_fingerprints(referenced)
+        return True
+
+    def flush(self):
+        with self.db:
+            # Other processes can't remove fingerprints while the write lock is held.
+            self.db.execute('BEGIN IMMEDIATE')
+            self._check_fingerprints()
+
+            if self._dirty:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO tasks (id, entry, generation) VALUES (?, ?, ?)',
+                    [(key, self._encode(self._entries[key]), self.generation) for key in self._dirty],
+                )
+
+            # Bump the generation of entries that were only read.
+            used = self._used - self._dirty
+            if used:
+                self.db.executemany(
+                    'UPDATE tasks SET generation = ? WHERE id = ?',
+                    ((self.generation, key) for key in used),
+                )
+
+            # Fingerprints are replaced as files change, so remove the unreferenced ones once the added ones make up a good part of them.
+            self.db.execute('UPDATE meta SET value = value + ? WHERE key = \'fingerprints_added\'', (self._fingerprints_added,))
+            self._fingerprints_added = 0
+            evicted = self.max_size is not None and self._evict()
+            if not evicted:
+                added, = self.db.execute('SELECT value FROM meta WHERE key = \'fingerprints_added\'').fetchone()
+                count, = self.db.execute('SELECT count(*) FROM fingerprints').fetchone()
+                if added > count // 2:
+                    self._remove_unreferenced_fingerprints()
+
+        self._dirty.clear()
+        self._used.clear()
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -1,27 +1,116 @@
 import asyncio
-import shelve
+import concurrent.futures
+import contextlib
+import multiprocessing
+import os
+import pathlib
 import sys
 
+from .artifact import ArtifactStore, HTTPArtifactCache
+from .cache import MemoryCache, SQLiteCache, metadata_digest
+from .file import File, FingerprintCache
+from .index import PrefixIndex
+from .scheduler import Engine, PrioritySemaphore, critical_path_priorities, topological_order
+from .trace import Tracer
+from .tracker import BlockingTracker, DeadlockError
+from ..util.jobserver import Jobserver
+from ..util.remote import RemoteExecutor
+
 __all__ = ['Context']
 
 _global_context = None
 
+_untraced = contextlib.nullcontext()
+
 class Context:
     def __init__(self, *,
         max_concurrent_tasks = None,
+        max_hash_workers = None,
+        workers = None,
+        hash_algorithm = 'sha256',
         cache_file = None,
+        cache_max_size = None,
+        artifact_cache = None,
+        artifact_cache_max_size = None,
+        remote_cache = None,
+        remote_cache_timeout = 10,
+        critical_path = True,
+        jobserver = False,
+        skip_clean = True,
+        remote_workers = None,
+        pools = None,
+        memory_budget = None,
+        trace_file = None,
     ):
         self.tasks = {}
         self.files = {}
         self._start_coros = []
+        self._stop_funcs = []
+        self._file_index = None
+        self._task_index = None
+
+        # Stats and hashing are blocking, so they're done in a separate thread pool, sized independently of the task limit.
+        self.max_hash_workers = max_hash_workers or os.cpu_count()
+        self.hash_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = self.max_hash_workers,
+            thread_name_prefix = 'erect-hash',
+        )
+        self.cpu_executor = None
+        self.fingerprints = FingerprintCache(self.hash_executor, hash_algorithm)
 
         self.max_concurrent_tasks = max_concurrent_tasks
-        self.task_semaphore = asyncio.Semaphore(max_concurrent_tasks or 1)
+
+        # With `jobserver = None`, join the jobserver of a parent make if there is one.
+        # With `jobserver = True`, also run our own otherwise, for child processes to share.
+        self.jobserver = None
+        if jobserver is not False:
+            self.jobserver = Jobserver.from_environ()
+        if self.jobserver is not None:
+            slots = max_concurrent_tasks or self.jobserver.jobs or os.cpu_count()
+        else:
+            slots = max_concurrent_tasks or 1
+            if jobserver:
+                self.jobserver = Jobserver.create(slots)
+
+        # Tasks are admitted by their weight, pool and memory use, see `Task.weight`.
+        self.task_semaphore = PrioritySemaphore(slots, self.jobserver, pools = pools, memory_budget = memory_budget)
+        self.tracker = BlockingTracker()
+        self.engine = None
+        self.workers = workers
+
+        if remote_workers:
+            self.remote_executor = RemoteExecutor(remote_workers)
+            self.start_async(self.remote_executor.start())
+        else:
+            self.remote_executor = None
+
+        self.critical_path = critical_path
+        self.skip_clean = skip_clean
+        self.tracer = Tracer(trace_file) if trace_file else None
+
+        # Up to date tasks with dependencies that ran.
+        self.cutoffs = 0
+        # Tasks marked done by the pre-pass.
+        self.skipped = 0
 
         if cache_file is False:
-            self.cache = {}
+            self.cache = MemoryCache()
+        else:
+            self.cache = SQLiteCache(cache_file or '.erect.sqlite', max_size = cache_max_size)
+
+        if remote_cache:
+            remote = HTTPArtifactCache(remote_cache, timeout = remote_cache_timeout)
+
+            # Remote artifacts are fetched into a local store.
+            if not artifact_cache:
+                artifact_cache = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')) / 'erect' / 'artifacts'
+        else:
+            remote = None
+
+        if artifact_cache:
+            self.artifacts = ArtifactStore(self, artifact_cache, max_size = artifact_cache_max_size, remote = remote)
         else:
-            self.cache = shelve.open(cache_file or '.erect')
+            self.artifacts = None
 
     def __enter__(self):
         global _global_context
@@ -36,29 +125,188 @@ class Context:
 
         _global_context = None
 
-    async def _check_deadlock(self, tg):
-        loop = asyncio.get_running_loop()
+        # Close the trace first, so it's complete even if anything below fails.
+        if self.tracer:
+            self.tracer.close()
+
+        self.cache.close()
+        if self.artifacts:
+            self.artifacts.close()
+        if self.jobserver:
+            self.jobserver.close()
+        self.hash_executor.shutdown()
+        if self.cpu_executor:
+            self.cpu_executor.shutdown()
+
+    async def run_cpu_bound(self, func, *args):
+        '''Run `func(*args)` in a pool of worker processes, or threads if the GIL is disabled, and return the result.
+
+        `func` must be importable by name in the workers, and its arguments and result must be picklable.
+        Functions of modules that aren't in `sys.modules`, like the blueprint, can't be imported by workers and run in a thread instead.
+        The pool is sized by the task limit, since callers hold a task slot while they wait.
+        '''
+
+        # Workers would import the module again by name, which for the blueprint would load it from scratch, if it's found at all.
+        module = getattr(func, '__module__', None)
+        if module is not None and module not in sys.modules:
+            return await asyncio.to_thread(func, *args)
+
+        if self.cpu_executor is None:
+            max_workers = min(self.task_semaphore.capacity, os.cpu_count())
+            if getattr(sys, '_is_gil_enabled', lambda: True)():
+                # Forking a process with running threads isn't safe.
+                self.cpu_executor = concurrent.futures.ProcessPoolExecutor(max_workers, mp_context = multiprocessing.get_context('forkserver'))
+            else:
+                self.cpu_executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix = 'erect-cpu')
+
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor, func, *args)
+
+    async def _skip_clean(self, order):
+        '''Mark tasks that are up to date along with all their dependencies as done, without scheduling them.
+
+        All files are stat'ed in bulk and only mtimes are compared, anything more is left to the regular up-to-date check.
+        '''
+
+        cache = self.cache
+        entries = {task: cache[task.id.mangled] for task in order if task.skippable_when_clean() and task.id.mangled in cache}
+
+        paths = set()
+        for task, entry in entries.items():
+            paths.update(entry.get('file_fingerprints', {}))
+            paths.update(f.path for f in task._input_files)
+            paths.update(f.path for f in task._output_files)
+        stats = await self.fingerprints.stat_many(paths)
+
+        def unchanged(path, fingerprint):
+            st = stats[path]
+            return st is not None and st.st_mtime_ns == fingerprint.mtime_ns and fingerprint.algorithm == self.fingerprints.algorithm
+
+        # Dependencies come first, so their state is known when their dependents are checked.
+        for task, entry in entries.items():
+            if not all(dep.done for dep in task._dependency_tasks()):
+                continue
+            if entry.get('input_metadata') != metadata_digest(task.input_metadata()):
+                continue
+            if not all(unchanged(path, fingerprint) for path, fingerprint in entry.get('file_fingerprints', {}).items()):
+                continue
+            if any(stats[f.path] is None for f in (*task._input_files, *task._output_files)):
+                continue
+
+            task.result = entry['result']
+            task.done = True
+            self.skipped += 1
 
-        while True:
-            await asyncio.sleep(0.1)
+    def _assign_priorities(self, order):
+        # Weigh tasks by the duration of their last run, falling back to the average for tasks that haven't run before.
+        durations = {}
+        for task in order:
+            duration = self.cache.get(task.id.mangled, {}).get('duration')
+            if duration is not None:
+                durations[task] = duration
+        default = sum(durations.values()) / len(durations) if durations else 1.0
 
-            if self.task_semaphore._value >= self.max_concurrent_tasks and not loop._ready:
-                tg._abort()
-                print('All remaining tasks are blocked, aborting.', file = sys.stderr)
-                return
+        priorities = critical_path_priorities(order, lambda task: durations.get(task, default))
+        for task, priority in priorities.items():
+            task.priority = priority
+
+    @staticmethod
+    def _task_id_key(id):
+        # Path-like elements are split into parts, so IDs can be matched by directory.
+        return [part for e in id for part in pathlib.PurePath(e).parts]
+
+    def find_files(self, path):
+        '''Return files at or below `path`.
+
+        The index is built on first use, so files added later aren't found.
+        '''
+
+        if self._file_index is None:
+            self._file_index = PrefixIndex((file.path.parts, file) for file in self.files.values())
+
+        return self._file_index.find(pathlib.PurePath(path).parts)
+
+    def find_tasks(self, prefix):
+        '''Return tasks with an ID starting with `prefix`, e.g. `compile build/` for all compile tasks in `build`.
+
+        `prefix` is either a string of space separated elements or a sequence of elements, and the last element may name a directory.
+        The index is built on first use, so tasks added later aren't found.
+        '''
+
+        if self._task_index is None:
+            self._task_index = PrefixIndex((self._task_id_key(id), task) for id, task in self.tasks.items())
+
+        if isinstance(prefix, str):
+            prefix = prefix.split()
+
+        return self._task_index.find(self._task_id_key(prefix))
+
+    def trace(self, name, cat, lane = None, args = None):
+        'Trace the block as a span if tracing is enabled, see `Tracer.span()`.'
+
+        if self.tracer is None:
+            return _untraced
+        return self.tracer.span(name, cat, lane, args)
 
     def start_async(self, coro):
         self._start_coros.append(coro)
 
+    def stop_async(self, func):
+        'Await the coroutine function `func` once `run()` finishes, however it ends.'
+
+        self._stop_funcs.append(func)
+
     async def run(self, tasks):
+        # Files may have changed since any previous run.
+        self.fingerprints.clear()
+
         for coro in self._start_coros:
             await coro
 
-        async with asyncio.TaskGroup() as tg:
-            asyncio.create_task(self._check_deadlock(tg))
+        roots = [task.generator_task if isinstance(task, File) else task for task in tasks]
+        roots = [task for task in roots if task is not None]
+
+        order = topological_order(roots)
+
+        if self.skip_clean:
+            with self.trace('skip clean tasks', 'cache'):
+                await self._skip_clean(order)
+            order = [task for task in order if not task.done]
+
+        if self.critical_path:
+            self._assign_priorities(order)
+
+        # Workers also check tasks, wait on hashing and remote commands outside of task slots, so have enough to keep everything busy.
+        workers = self.workers or self.task_semaphore.capacity + self.max_hash_workers + (self.remote_executor.capacity if self.remote_executor else 0)
+
+        self.engine = Engine(order, workers)
+        self.tracker = BlockingTracker(asyncio.get_running_loop().create_future(), on_block = self.engine.rebalance)
+
+        build_task = asyncio.create_task(self.engine.run(self.tracker))
+        try:
+            await asyncio.wait([build_task, self.tracker.deadlock], return_when = asyncio.FIRST_COMPLETED)
+
+            if not build_task.done():
+                build_task.cancel()
+                await asyncio.gather(build_task, return_exceptions = True)
+                raise DeadlockError(self.tracker.deadlock.result())
+
+            await build_task
+
+        finally:
+            for func in self._stop_funcs:
+                await func()
+
+            # Cache writes are batched per build.
+            with self.trace('flush cache', 'cache'):
+                self.cache.flush()
+
+            if self.artifacts:
+                await self.artifacts.finish()
+
+            self.task_semaphore.close()
 
-            for task in tasks:
-                tg.create_task(task._run())
+            if self.tracer:
+                self.tracer.flush()
 
 def get_global_context():
     assert _global_context is not None, 'Global context is not set.'
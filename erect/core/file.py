@@ -1,40 +1,170 @@
+import os
 import pathlib
 import asyncio
-import hashlib
 from dataclasses import dataclass
 
-__all__ = ['Fingerprint', 'File']
+from .hash import hash_file
 
-# TODO: memoize?
-def _hash_file(path):
-    with open(path, 'rb') as f:
-        return hashlib.file_digest(f, 'sha256').digest()
+__all__ = ['Fingerprint', 'FingerprintCache', 'File']
+
+STAT_BATCH = 1024
+'Number of files stat\'ed per executor call by `FingerprintCache.stat_many()`.'
+
+def _stat(path):
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
 
 @dataclass
 class Fingerprint:
     mtime_ns: int
     hash: bytes
+    algorithm: str = 'sha256'
+
+class FingerprintCache:
+    '''Memoizes file stats and hashes for the duration of a build.
+
+    Stats are keyed by path, hashes by (device, inode, size, mtime_ns), so a file is stat'ed once and hashed at most once unless it is invalidated.
+    The blocking calls run in `executor`, concurrent requests for the same file share a single call.
+    '''
+
+    def __init__(self, executor = None, algorithm = 'sha256'):
+        self.executor = executor
+        self.algorithm = algorithm
+        self._stats = {}
+        self._hashes = {}
+
+        self.stat_hits = 0
+        self.stat_misses = 0
+        self.hash_hits = 0
+        self.hash_misses = 0
+        self.restats = 0
+
+    def clear(self):
+        self._stats.clear()
+        self._hashes.clear()
+
+    def _submit(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def stat(self, path):
+        'Return the stat result for `path`, or None if it doesn\'t exist.'
+
+        path = pathlib.Path(path)
+        if path in self._stats:
+            self.stat_hits += 1
+        else:
+            self.stat_misses += 1
+            self._stats[path] = self._submit(_stat, path)
+
+        return await self._stats[path]
+
+    async def stat_many(self, paths):
+        '''Return a dict mapping each of `paths` to its stat result, or None if it doesn't exist.
+
+        Missing stats are done in large batches, rather than one executor call per file.
+        '''
+
+        paths = {path if isinstance(path, pathlib.Path) else pathlib.Path(path) for path in paths}
+        missing = [path for path in paths if path not in self._stats]
+        self.stat_hits += len(paths) - len(missing)
+        self.stat_misses += len(missing)
+
+        loop = asyncio.get_running_loop()
+        for path in missing:
+            self._stats[path] = loop.create_future()
+
+        async def stat_batch(batch):
+            futures = [self._stats[path] for path in batch]
+            try:
+                results = await self._submit(lambda: [_stat(path) for path in batch])
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                raise
+            for future, st in zip(futures, results):
+                future.set_result(st)
+
+        await asyncio.gather(*(stat_batch(missing[i:i + STAT_BATCH]) for i in range(0, len(missing), STAT_BATCH)))
+
+        return {path: await self._stats[path] for path in paths}
+
+    async def hash(self, path):
+        st = await self.stat(path)
+        assert st is not None, f'Can\'t hash missing file {path}.'
+
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        if key in self._hashes:
+            self.hash_hits += 1
+        else:
+            self.hash_misses += 1
+            self._hashes[key] = self._submit(hash_file, path, self.algorithm)
 
-    @classmethod
-    def create(cls, path):
-        assert path.exists()
+        return await self._hashes[key]
 
-        return cls(
-            mtime_ns = path.stat().st_mtime_ns,
-            hash = _hash_file(path),
+    def invalidate(self, path):
+        'Forget the stat result for `path`, e.g. after a task has (re)written it.'
+
+        self._stats.pop(pathlib.Path(path), None)
+
+    async def restat(self, fingerprint, path):
+        '''Give `path` back the mtime of `fingerprint` if it was rewritten with identical content.
+
+        Readers of the file then see it as unchanged without hashing it again.
+        Returns True if the file matches `fingerprint` afterwards.
+        '''
+
+        if fingerprint.algorithm != self.algorithm:
+            return False
+
+        st = await self.stat(path)
+        if st is None:
+            return False
+        if st.st_mtime_ns == fingerprint.mtime_ns:
+            return True
+
+        if await self.hash(path) != fingerprint.hash:
+            return False
+
+        await self._submit(lambda: os.utime(path, ns = (st.st_atime_ns, fingerprint.mtime_ns)))
+        self.invalidate(path)
+
+        # The content is known, so don't hash it again under the restored mtime.
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(fingerprint.hash)
+        self._hashes[(st.st_dev, st.st_ino, st.st_size, fingerprint.mtime_ns)] = future
+
+        self.restats += 1
+        return True
+
+    async def fingerprint(self, path):
+        st = await self.stat(path)
+        assert st is not None
+
+        return Fingerprint(
+            mtime_ns = st.st_mtime_ns,
+            hash = await self.hash(path),
+            algorithm = self.algorithm,
         )
 
-    def check(self, path):
+    async def check(self, fingerprint, path):
+        # Fingerprints made with another algorithm can't be compared, treat them as stale.
+        if fingerprint.algorithm != self.algorithm:
+            return False
+
+        st = await self.stat(path)
+
         # Files that doesn't exist matches nothing.
-        if not path.exists():
+        if st is None:
             return False
-        
+
         # Assume file is unchanged if mtime matches.
-        if path.stat().st_mtime_ns == self.mtime_ns:
+        if st.st_mtime_ns == fingerprint.mtime_ns:
             return True
 
         # Check if hash is matching.
-        return _hash_file(path) == self.hash
+        return await self.hash(path) == fingerprint.hash
 
 class File:
     path: pathlib.Path
@@ -59,11 +189,5 @@ class File:
         assert self._generator_task is None
         self._generator_task = task
 
-    async def _run(self):
-        if self.generator_task is not None:
-            await self.generator_task._run()
-
-        assert self.path.exists()
-
-    def get_fingerprint(self):
-        return Fingerprint.create(self.path)
+    async def get_fingerprint(self):
+        return await self.ctx.fingerprints.fingerprint(self.path)
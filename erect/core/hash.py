@@ -0,0 +1,51 @@
+import hashlib
+import mmap
+import os
+
+__all__ = ['register_hash_algorithm', 'hash_algorithms']
+
+# Files at least this large are hashed through a memory map instead of buffered reads.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+_algorithms = {}
+
+def register_hash_algorithm(name, constructor):
+    '''Make a hash algorithm available for fingerprints.
+
+    `constructor` is called without arguments and must return a hashlib-like object providing `update()` and `digest()`.
+    '''
+
+    _algorithms[name] = constructor
+
+def hash_algorithms():
+    return list(_algorithms)
+
+register_hash_algorithm('sha256', hashlib.sha256)
+register_hash_algorithm('blake2b', hashlib.blake2b)
+
+# Third-party hashes are used if they're installed.
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    register_hash_algorithm('xxh3_128', xxhash.xxh3_128)
+
+try:
+    import blake3
+except ImportError:
+    pass
+else:
+    register_hash_algorithm('blake3', blake3.blake3)
+
+def hash_file(path, algorithm):
+    constructor = _algorithms[algorithm]
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return hashlib.file_digest(f, constructor).digest()
+
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as m:
+            h = constructor()
+            h.update(m)
+            return h.digest()
@@ -0,0 +1,45 @@
+__all__ = ['PrefixIndex']
+
+class _Node:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+
+class PrefixIndex:
+    '''Trie mapping sequences of keys, like path parts, to values.
+
+    Finding the values under a prefix takes time proportional to the prefix length and the number of matches, regardless of the size of the index.
+    '''
+
+    def __init__(self, items = ()):
+        self._root = _Node()
+        for key, value in items:
+            self.add(key, value)
+
+    def add(self, key, value):
+        node = self._root
+        for part in key:
+            child = node.children.get(part)
+            if child is None:
+                child = node.children[part] = _Node()
+            node = child
+        node.values.append(value)
+
+    def find(self, prefix):
+        'Return all values with keys starting with `prefix`, in insertion order per key.'
+
+        node = self._root
+        for part in prefix:
+            node = node.children.get(part)
+            if node is None:
+                return []
+
+        values = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            values.extend(node.values)
+            stack.extend(reversed(node.children.values()))
+        return values
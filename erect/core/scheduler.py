@@ -0,0 +1,323 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+
+from .tracker import DeadlockError
+
+__all__ = ['PrioritySemaphore', 'Engine', 'topological_order', 'critical_path_priorities']
+
+class PrioritySemaphore:
+    '''Semaphore admitting waiters in order of descending priority, weighted by what they use.
+
+    Waiters with equal priority are woken in FIFO order.
+    Each waiter takes `weight` of the slots, up to all of them, and `memory` MB of `memory_budget` if set.
+    A waiter wanting more memory than the budget is admitted once no other waiter holds any.
+    Waiters may also be in a named pool, and at most `pools[name]` waiters of a pool are admitted at once, pools without a limit are unlimited.
+
+    A waiter held back by its pool is set aside until a waiter of the pool releases, so it doesn't hold up the others.
+    A waiter held back by slots or memory does hold up waiters after it, so heavy tasks aren't starved by lighter ones.
+
+    If `jobserver` is set, every slot beyond the first one held also requires a jobserver token.
+    Tokens are fetched one at a time while there are waiters, handed to the waiter with the highest priority, and returned as soon as they're no longer needed.
+    '''
+
+    def __init__(self, value = 1, jobserver = None, pools = None, memory_budget = None):
+        self.capacity = value
+        self._value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+        self.pools = dict(pools or {})
+        self._pool_held = dict.fromkeys(self.pools, 0)
+        self._pool_waiters = {pool: [] for pool in self.pools}
+        self.memory_budget = memory_budget
+        self._memory_held = 0
+
+        self._jobserver = jobserver
+        self._held = 0
+        self._tokens = []
+        self._fetching = None
+
+    def locked(self):
+        return self._value == 0
+
+    def _pool_full(self, pool):
+        return pool in self.pools and self._pool_held[pool] >= self.pools[pool]
+
+    def _missing(self, weight, memory):
+        'What keeps a waiter from being admitted: `slots`, `memory`, `token` or None.'
+
+        if self._value < weight:
+            return 'slots'
+        if self.memory_budget is not None and self._memory_held and self._memory_held + memory > self.memory_budget:
+            return 'memory'
+        if self._jobserver is not None and self._held + weight - 1 > len(self._tokens):
+            return 'token'
+        return None
+
+    def _grant(self, weight, pool, memory):
+        self._value -= weight
+        self._held += weight
+        self._memory_held += memory
+        if pool in self.pools:
+            self._pool_held[pool] += 1
+
+    async def acquire(self, priority = 0, weight = 1, pool = None, memory = 0):
+        weight = min(weight, self.capacity)
+        if not self._waiters and not self._pool_full(pool) and self._missing(weight, memory) is None:
+            self._grant(weight, pool, memory)
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (-priority, next(self._counter), future, weight, pool, memory))
+        self._wake()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Pass on the slot if we were woken and cancelled at the same time.
+            if future.done() and not future.cancelled():
+                self.release(weight, pool, memory)
+            raise
+
+        return True
+
+    def release(self, weight = 1, pool = None, memory = 0):
+        weight = min(weight, self.capacity)
+        self._value += weight
+        self._held -= weight
+        self._memory_held -= memory
+
+        # Put back the first waiter set aside for the pool.
+        if pool in self.pools:
+            self._pool_held[pool] -= 1
+            waiters = self._pool_waiters[pool]
+            while waiters:
+                entry = heapq.heappop(waiters)
+                if not entry[2].done():
+                    heapq.heappush(self._waiters, entry)
+                    break
+
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            _, _, future, weight, pool, memory = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+
+            if self._pool_full(pool):
+                heapq.heappush(self._pool_waiters[pool], heapq.heappop(self._waiters))
+                continue
+
+            missing = self._missing(weight, memory)
+            if missing is not None:
+                if missing == 'token' and self._fetching is None:
+                    self._fetching = asyncio.create_task(self._fetch_token())
+                break
+
+            heapq.heappop(self._waiters)
+            self._grant(weight, pool, memory)
+            future.set_result(None)
+
+        # Return tokens not covering any held slot.
+        while self._jobserver is not None and len(self._tokens) > max(self._held - 1, 0):
+            self._jobserver.release(self._tokens.pop())
+
+    async def _fetch_token(self):
+        try:
+            self._tokens.append(await self._jobserver.acquire())
+        finally:
+            self._fetching = None
+        self._wake()
+
+    def close(self):
+        'Stop fetching tokens and return any that are held.'
+
+        if self._fetching is not None:
+            self._fetching.cancel()
+
+        while self._tokens:
+            self._jobserver.release(self._tokens.pop())
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority = 0, weight = 1, pool = None, memory = 0):
+        await self.acquire(priority, weight, pool, memory)
+        try:
+            yield
+        finally:
+            self.release(weight, pool, memory)
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+def topological_order(tasks):
+    '''Order the tasks reachable from `tasks` so dependencies come before their dependents.
+
+    Tasks that are already done are left out, along with everything only reachable through them.
+    Raises DeadlockError if the tasks depend on each other in a cycle.
+    '''
+
+    # Iterative DFS, so deep graphs don't hit the recursion limit.
+    # `path` holds the tasks being expanded, from a root down to the current one, so reaching one of them again is a cycle.
+    order = []
+    visited = set()
+    path = []
+    on_path = set()
+    stack = [(task, False) for task in tasks if not task.done]
+
+    while stack:
+        task, expanded = stack.pop()
+        if expanded:
+            path.pop()
+            on_path.discard(task)
+            order.append(task)
+            continue
+
+        if task in on_path:
+            cycle = path[path.index(task):] + [task]
+            raise DeadlockError('Dependency cycle: ' + ' -> '.join(t.id.str for t in cycle))
+
+        if task in visited:
+            continue
+        visited.add(task)
+        path.append(task)
+        on_path.add(task)
+
+        stack.append((task, True))
+        for dep in task._dependency_tasks():
+            if dep in on_path or (dep not in visited and not dep.done):
+                stack.append((dep, False))
+
+    return order
+
+def critical_path_priorities(order, weight):
+    '''Compute the longest weighted path from each task to a sink of the graph.
+
+    `order` is the graph to consider in topological order, and `weight` is called with each task to get its expected duration.
+    Returns a dict mapping each task to its priority.
+    '''
+
+    dependents = {task: [] for task in order}
+    for task in order:
+        for dep in task._dependency_tasks():
+            if dep in dependents:
+                dependents[dep].append(task)
+
+    priorities = {}
+    for task in reversed(order):
+        priorities[task] = weight(task) + max((priorities[t] for t in dependents[task]), default = 0)
+
+    return priorities
+
+class Engine:
+    '''Runs a task graph, given in topological order, from a ready queue.
+
+    Every task counts its dependencies that aren't done yet, and is queued once the count drops to zero.
+    A fixed number of workers take queued tasks in order of descending priority and execute them.
+    Workers whose task is blocked on another task are replaced by extra workers until it unblocks, so blocked tasks can't starve the queue.
+    '''
+
+    def __init__(self, order, workers):
+        start = time.perf_counter()
+
+        self.workers = workers
+        self.order = order
+        self.tracker = None
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._left = len(self.order)
+        self._running = 0
+        self._worker_tasks = set()
+        self._tg = None
+        self._finished = None
+
+        self._remaining = {}
+        self._dependents = {task: [] for task in self.order}
+        for task in self.order:
+            dependencies = {dep for dep in task._dependency_tasks() if not dep.done}
+            self._remaining[task] = len(dependencies)
+            for dep in dependencies:
+                self._dependents[dep].append(task)
+
+        # Time spent on bookkeeping rather than executing tasks.
+        self.overhead = time.perf_counter() - start
+
+    def _push(self, task):
+        self.tracker.start(task)
+        self._queue.put_nowait((-task.priority, next(self._counter), task))
+
+    def _complete(self, task):
+        start = time.perf_counter()
+
+        # Queue dependents before reporting the task finished, so the tracker never sees a moment without runnable tasks.
+        for dependent in self._dependents.pop(task):
+            self._remaining[dependent] -= 1
+            if not self._remaining[dependent]:
+                self._push(dependent)
+        self.tracker.finished(task)
+
+        self._left -= 1
+        if not self._left:
+            self._finished.set_result(None)
+
+        self.overhead += time.perf_counter() - start
+
+    def _spawn(self):
+        self._running += 1
+        worker = self._tg.create_task(self._worker())
+        self._worker_tasks.add(worker)
+        worker.add_done_callback(self._worker_tasks.discard)
+
+    def rebalance(self):
+        'Start extra workers to replace the ones held by blocked tasks.'
+
+        while self._tg is not None and self._running < self.workers + len(self.tracker.blocked):
+            self._spawn()
+
+    async def _worker(self):
+        try:
+            while True:
+                _, _, task = await self._queue.get()
+                await task._execute()
+                self._complete(task)
+
+                # Extra workers retire when the tasks they replaced are unblocked.
+                if self._running > self.workers + len(self.tracker.blocked):
+                    return
+        finally:
+            self._running -= 1
+
+    async def run(self, tracker):
+        self.tracker = tracker
+
+        if not self.order:
+            return
+
+        self._finished = asyncio.get_running_loop().create_future()
+        for task in self.order:
+            if not self._remaining[task]:
+                self._push(task)
+
+        # Nothing would ever become ready, as with an order that isn't topological.
+        if self._queue.empty():
+            raise DeadlockError(f'None of the {len(self.order)} remaining tasks are ready to run.')
+
+        async with asyncio.TaskGroup() as tg:
+            self._tg = tg
+            for _ in range(min(self.workers, len(self.order))):
+                self._spawn()
+
+            await self._finished
+
+            # Remaining workers are idle.
+            for worker in self._worker_tasks:
+                worker.cancel()
+
+        self._tg = None
@@ -1,12 +1,20 @@
 import asyncio
+import contextvars
+import dataclasses
+import itertools
+import math
 import time
 import pathlib
 import contextlib
 
-from .context import Context
+from .cache import metadata_digest
+from .context import Context, _untraced
 from .file import File
 
-__all__ = ['TaskExists', 'TaskID', 'Task']
+__all__ = ['TaskExists', 'TaskID', 'Task', 'current_task']
+
+current_task = contextvars.ContextVar('current_task', default = None)
+'The task whose `_run` is executing in the current asyncio task.'
 
 class TaskExists(Exception):
     def __init__(self, id, task):
@@ -42,6 +50,31 @@ class Task:
     ctx: Context
     id: TaskID
 
+    artifact_cacheable = False
+    'Whether outputs of this task can be stored in and restored from the artifact store.'
+
+    cpu_bound = False
+    '''Whether this task is CPU-bound Python work.
+
+    The default `run()` of CPU-bound tasks calls `compute()` with the arguments from `compute_args()` in a worker process, see `Context.run_cpu_bound()`.
+    Workers import `compute()` by name, so one defined in the blueprint runs in a thread instead, and should be moved to an importable module to run in parallel.
+    '''
+
+    weight = 1
+    'Task slots taken while running, e.g. by tools running several threads.'
+
+    pool = None
+    '''Name of a pool of tasks limited to run a number at a time, e.g. `'link'`.
+
+    Limits are set with `Context(pools = ...)`, and pools without a limit aren't limited.
+    '''
+
+    memory = None
+    '''Estimated peak memory use in MB, counted against `Context(memory_budget = ...)`.
+
+    Defaults to the max RSS of its subprocesses in the last run, see `resources`.
+    '''
+
     def __new__(cls, ctx, id):
         id = TaskID(id)
         if id in ctx.tasks:
@@ -50,13 +83,18 @@ class Task:
         self.ctx = ctx
         self.id = id
         self.dependencies = []
-        self.lock = asyncio.Lock()
         self.done = False
+        self.ran = False
         self.result = None
+        self.priority = 0
+        self.resources = None
 
         self._input_files = []
         self._output_files = []
         self._events = []
+        self._admission = None
+        self._trace_lane = None
+        self._trace_start = None
         return self
 
     def add_input_files(self, *files):
@@ -70,81 +108,261 @@ class Task:
             assert file.generator_task is None
             file.generator_task = self
 
+    def _dependency_tasks(self):
+        return [*self.dependencies, *(f.generator_task for f in self._input_files if f.generator_task is not None)]
+
     def input_metadata(self):
         return {}
 
+    def toolchain_identity(self):
+        'Identifies the tools used by this task, for artifact store keys.'
+
+        return None
+
+    def artifact_root(self):
+        'Directory that output paths are relative to in the artifact store.'
+
+        return None
+
+    def artifact_outputs(self):
+        'Files stored in the artifact store after a run.'
+
+        return [f.path for f in self._output_files]
+
+    def artifact_restorable(self, path):
+        'Whether an output may be restored to `path` from the artifact store, by default only to the declared outputs.'
+
+        return any(f.path == path for f in self._output_files)
+
+    def skippable_when_clean(self):
+        'Whether this task can be marked done without calling any of its hooks when it and all its dependencies are up to date.'
+
+        return type(self).pre_run is Task.pre_run and type(self).post_run is Task.post_run
+
     async def pre_run(self):
         pass
 
+    def compute_args(self):
+        'Arguments for `compute()`, which must be picklable.'
+
+        return ()
+
+    @staticmethod
+    def compute(*args):
+        'Body of CPU-bound tasks, run in a worker process. The result must be picklable.'
+
+        raise NotImplementedError()
+
     async def run(self):
+        if self.cpu_bound:
+            return await self.ctx.run_cpu_bound(type(self).compute, *self.compute_args())
+
         raise NotImplementedError()
 
     async def post_run(self):
         pass
 
-    def _uptodate(self):
+    async def _uptodate(self):
         # Uncached tasks are not up to date.
         if not self.id.mangled in self.ctx.cache:
             return False
         cache = self.ctx.cache[self.id.mangled]
 
         # Check if input metadata changed.
-        if cache.get('input_metadata') != self.input_metadata():
+        if cache.get('input_metadata') != metadata_digest(self.input_metadata()):
             return False
 
         # Check if any files doesn't match their fingerprints.
-        for path, fingerprint in cache.get('file_fingerprints', {}).items():
-            if not fingerprint.check(path):
-                return False
+        fingerprints = self.ctx.fingerprints
+        matches = await asyncio.gather(*(fingerprints.check(fingerprint, path) for path, fingerprint in cache.get('file_fingerprints', {}).items()))
+        if not all(matches):
+            return False
 
         for f in self._input_files:
-            assert f.path.exists(), f'Required file {f.path} for task {self.id} does not exist.'
+            assert await fingerprints.stat(f.path) is not None, f'Required file {f.path} for task {self.id} does not exist.'
 
         for f in self._output_files:
-            if not f.path.exists():
+            if await fingerprints.stat(f.path) is None:
                 return False
 
         return True
 
-    def _save_cache(self):
+    async def _restat_outputs(self):
+        'Keep the previous fingerprints of outputs that were rewritten with identical content, so dependents are cut off from rerunning.'
+
+        previous = self.ctx.cache.get(self.id.mangled, {}).get('file_fingerprints')
+        if not previous:
+            return
+
+        await asyncio.gather(*(self.ctx.fingerprints.restat(previous[f.path], f.path) for f in self._output_files if f.path in previous))
+
+    async def _refresh_fingerprints(self):
+        'Record new mtimes of files that were touched without changing, so they don\'t need to be hashed again.'
+
+        entry = self.ctx.cache[self.id.mangled]
+        fingerprints = entry.get('file_fingerprints', {})
+        stats = await asyncio.gather(*(self.ctx.fingerprints.stat(path) for path in fingerprints))
+        if all(st.st_mtime_ns == fingerprint.mtime_ns for st, fingerprint in zip(stats, fingerprints.values())):
+            return
+
+        self.ctx.cache[self.id.mangled] = entry | {
+            'file_fingerprints': {path: dataclasses.replace(fingerprint, mtime_ns = st.st_mtime_ns) for (path, fingerprint), st in zip(fingerprints.items(), stats)},
+        }
+
+    def add_resource_usage(self, rusage):
+        'Add the resource usage of a finished subprocess, as returned by `os.wait4()`, to `resources`.'
+
+        resources = self.resources or {'processes': 0, 'user_time': 0.0, 'system_time': 0.0, 'max_rss': 0, 'read_blocks': 0, 'written_blocks': 0}
+        self.resources = resources | {
+            'processes': resources['processes'] + 1,
+            'user_time': resources['user_time'] + rusage.ru_utime,
+            'system_time': resources['system_time'] + rusage.ru_stime,
+            'max_rss': max(resources['max_rss'], rusage.ru_maxrss),
+            'read_blocks': resources['read_blocks'] + rusage.ru_inblock,
+            'written_blocks': resources['written_blocks'] + rusage.ru_oublock,
+        }
+
+    def _admission_request(self):
+        'Weight, pool and memory this task asks the task semaphore for.'
+
+        memory = self.memory
+        if memory is None and self.ctx.task_semaphore.memory_budget is not None:
+            resources = self.ctx.cache.get(self.id.mangled, {}).get('resources')
+            memory = resources['max_rss'] / 1024 if resources else 0
+
+        return {
+            'weight': self.weight,
+            'pool': self.pool,
+            'memory': math.ceil(memory or 0),
+        }
+
+    def _trace(self, name, cat):
+        'Trace the block as a span of this task, in the lane of its task slot while it holds one.'
+
+        if self.ctx.tracer is None:
+            return _untraced
+        if self._trace_lane is None:
+            return self.ctx.tracer.span(name, cat, args = {'task': self.id.str})
+        return self._trace_in_slot(name, cat)
+
+    @contextlib.contextmanager
+    def _trace_in_slot(self, name, cat):
+        tracer = self.ctx.tracer
+        lane, slot_start = self._trace_lane, self._trace_start
+        start = tracer.now()
+        args = {'task': self.id.str}
+        try:
+            yield args
+        finally:
+            # If the task was suspended meanwhile its lane was given up, and the span no longer nests in it.
+            if (self._trace_lane, self._trace_start) == (lane, slot_start):
+                tracer.complete(tracer.SLOTS, lane, name, cat, start, args = args)
+            else:
+                tracer.complete_async(tracer.SLOTS, name, cat, start, args = args)
+
+    def _trace_slot_start(self):
+        tracer = self.ctx.tracer
+        if tracer is not None:
+            self._trace_lane = tracer.lane(tracer.SLOTS)
+            self._trace_start = tracer.now()
+
+    def _trace_slot_end(self):
+        tracer = self.ctx.tracer
+        if tracer is not None and self._trace_lane is not None:
+            tracer.complete(tracer.SLOTS, self._trace_lane, self.id.str, 'task', self._trace_start)
+            tracer.release(tracer.SLOTS, self._trace_lane)
+            self._trace_lane = None
+
+    def _running_time(self):
+        'Time spent running (not suspended) so far, according to the recorded events.'
+
+        events = [*self._events, (time.monotonic(), None)]
+        return sum(end - start for (start, e), (end, _) in itertools.pairwise(events) if e == 'running')
+
+    async def _save_cache(self, duration = None):
+        files = [*self._input_files, *self._output_files]
+        fingerprints = await asyncio.gather(*(f.get_fingerprint() for f in files))
+
+        # Keep the last measured duration and resource usage if the task didn't actually run.
+        previous = self.ctx.cache.get(self.id.mangled, {})
+        if duration is None:
+            duration = previous.get('duration')
+        resources = self.resources if self.resources is not None else previous.get('resources')
+
         self.ctx.cache[self.id.mangled] = {
-            'input_metadata': self.input_metadata(),
-            'file_fingerprints': {f.path: f.get_fingerprint() for f in [*self._input_files, *self._output_files]},
+            'input_metadata': metadata_digest(self.input_metadata()),
+            'file_fingerprints': {f.path: fingerprint for f, fingerprint in zip(files, fingerprints)},
             'result': self.result,
+            'duration': duration,
+            'resources': resources,
         }
 
-    async def _run(self):
-        async with self.lock:
-            if self.done:
-                return self.result
+    async def _execute(self):
+        'Run this task if it\'s not up to date. Called by the engine once all dependencies are done.'
+
+        current_task.set(self)
 
-            await async_run(self.dependencies + self._input_files)
+        if self._input_files:
+            with self._trace('stat inputs', 'fingerprint'):
+                stats = await self.ctx.fingerprints.stat_many(f.path for f in self._input_files)
+            missing = [path for path, st in stats.items() if st is None]
+            assert not missing, f'Required files {", ".join(map(str, missing))} for task {self.id.str} do not exist.'
 
-            await self.pre_run()
+        await self.pre_run()
 
-            async with self.ctx.task_semaphore:
-                self._events.append((time.monotonic(), 'running'))
-                if self._uptodate():
+        with self._trace('cache lookup', 'cache'):
+            uptodate = await self._uptodate()
+
+        # Look up outputs in the artifact store before taking a task slot, so slow fetches don't hold up other tasks.
+        artifacts = self.ctx.artifacts if self.artifact_cacheable and not uptodate else None
+        restored = False
+        if artifacts:
+            with self._trace('artifact lookup', 'cache'):
+                artifact_key = await artifacts.key(self)
+                restored = await artifacts.restore(self, artifact_key)
+
+        self._admission = self._admission_request()
+        async with self.ctx.task_semaphore.slot(self.priority, **self._admission):
+            self._events.append((time.monotonic(), 'running'))
+            self._trace_slot_start()
+            try:
+                if uptodate:
                     self.result = self.ctx.cache[self.id.mangled]['result']
+                    await self._refresh_fingerprints()
+
+                    # Dependencies ran, but all of their outputs we use are unchanged.
+                    if any(task.ran for task in self._dependency_tasks()):
+                        self.ctx.cutoffs += 1
                 else:
-                    self.result = await self.run()
-                    self._save_cache()
+                    self.ran = True
+                    duration = None
+                    if not restored:
+                        self.result = await self.run()
+                        duration = self._running_time()
+                        for f in self._output_files:
+                            self.ctx.fingerprints.invalidate(f.path)
+                        await self._restat_outputs()
+
+                        if artifacts:
+                            await artifacts.store(self, artifact_key)
+
+                    with self._trace('fingerprint outputs', 'fingerprint'):
+                        await self._save_cache(duration)
                 await self.post_run()
                 self._events.append((time.monotonic(), 'done'))
+            finally:
+                self._trace_slot_end()
 
-            self.done = True
+        self.done = True
 
     @contextlib.asynccontextmanager
     async def mark_suspended(self):
         self._events.append((time.monotonic(), 'suspended'))
-        self.ctx.task_semaphore.release()
+        self._trace_slot_end()
+        self.ctx.task_semaphore.release(**self._admission)
         try:
             yield
         finally:
-            await self.ctx.task_semaphore.acquire()
+            await self.ctx.task_semaphore.acquire(self.priority, **self._admission)
+            self._trace_slot_start()
             self._events.append((time.monotonic(), 'running'))
-
-async def async_run(tasks):
-    async with asyncio.TaskGroup() as tg:
-        for task in tasks:
-            tg.create_task(task._run())
@@ -0,0 +1,116 @@
+import contextlib
+import heapq
+import json
+import time
+
+__all__ = ['Tracer']
+
+_encode = json.JSONEncoder(separators = (',', ':'), check_circular = False).encode
+
+class Tracer:
+    '''Writes Chrome trace events to a file while the build runs, for viewing in Perfetto or `chrome://tracing`.
+
+    The file is a JSON array that's only closed by `close()`, which trace viewers accept without the closing bracket, so the trace of a failed or interrupted build still loads.
+    Events are buffered and written in batches of whole events.
+
+    Work in task slots is shown in one lane per slot.
+    Work outside task slots, like up-to-date checks and waiting for modules, is shown in lanes of its own.
+    '''
+
+    SLOTS = 1
+    OTHER = 2
+
+    FLUSH_EVENTS = 1000
+
+    def __init__(self, filename):
+        self.file = open(filename, 'w')
+        self._buffer = []
+        self._separator = '[\n'
+        self._start = time.perf_counter()
+        self._free = {self.SLOTS: [], self.OTHER: []}
+        self._lanes = {self.SLOTS: 0, self.OTHER: 0}
+        self._async_ids = 0
+
+        self._event({'ph': 'M', 'pid': self.SLOTS, 'name': 'process_name', 'args': {'name': 'Task slots'}})
+        self._event({'ph': 'M', 'pid': self.OTHER, 'name': 'process_name', 'args': {'name': 'Outside task slots'}})
+
+    def now(self):
+        'Microseconds since the trace started.'
+
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _event(self, event):
+        self._buffer.append(self._separator + _encode(event))
+        self._separator = ',\n'
+        if len(self._buffer) >= self.FLUSH_EVENTS:
+            self.flush()
+
+    def lane(self, pid):
+        'Take the lowest free lane of `pid`, one of `SLOTS` and `OTHER`.'
+
+        if self._free[pid]:
+            return heapq.heappop(self._free[pid])
+
+        self._lanes[pid] += 1
+        lane = self._lanes[pid]
+        self._event({'ph': 'M', 'pid': pid, 'tid': lane, 'name': 'thread_name', 'args': {'name': f'{"slot" if pid == self.SLOTS else "lane"} {lane}'}})
+        self._event({'ph': 'M', 'pid': pid, 'tid': lane, 'name': 'thread_sort_index', 'args': {'sort_index': lane}})
+        return lane
+
+    def release(self, pid, lane):
+        heapq.heappush(self._free[pid], lane)
+
+    def complete(self, pid, lane, name, cat, start, end = None, args = None):
+        'Record a span from `start` to `end`, or now, in microseconds.'
+
+        if end is None:
+            end = self.now()
+
+        event = {'ph': 'X', 'pid': pid, 'tid': lane, 'name': name, 'cat': cat, 'ts': round(start, 1), 'dur': round(end - start, 1)}
+        if args:
+            event['args'] = args
+        self._event(event)
+
+    def complete_async(self, pid, name, cat, start, end = None, args = None):
+        '''Record a span from `start` to `end`, or now, on a track of its own.
+
+        For spans that don't fit in a single lane, like those of a task that was suspended meanwhile.
+        '''
+
+        if end is None:
+            end = self.now()
+
+        self._async_ids += 1
+        event = {'ph': 'b', 'pid': pid, 'id': self._async_ids, 'name': name, 'cat': cat, 'ts': round(start, 1)}
+        if args:
+            event['args'] = args
+        self._event(event)
+        self._event({'ph': 'e', 'pid': pid, 'id': self._async_ids, 'name': name, 'cat': cat, 'ts': round(end, 1)})
+
+    @contextlib.contextmanager
+    def span(self, name, cat, lane = None, args = None):
+        '''Record the time spent in the block as a span, in `lane` of the task slots, or a free lane outside task slots if None.
+
+        Yields the span's arguments, which may be added to before the block ends.
+        '''
+
+        args = dict(args or {})
+        pid = self.SLOTS if lane is not None else self.OTHER
+        tid = lane if lane is not None else self.lane(self.OTHER)
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.complete(pid, tid, name, cat, start, args = args)
+            if lane is None:
+                self.release(self.OTHER, tid)
+
+    def flush(self):
+        self.file.write(''.join(self._buffer))
+        self.file.flush()
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self.file.write('\n]\n')
+        self.file.close()
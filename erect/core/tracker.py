@@ -0,0 +1,78 @@
+__all__ = ['DeadlockError', 'BlockingTracker']
+
+class DeadlockError(Exception):
+    pass
+
+class BlockingTracker:
+    '''Tracks which tasks are able to make progress, to detect deadlocks the moment they happen.
+
+    Tasks are started once all their dependencies are done, and are then either runnable or blocked.
+    Runnable tasks are queued, doing their own work or waiting for a task slot, all of which will make progress as long as any task is runnable.
+    Blocked tasks wait for something another task provides, like a module, and are reported by `block()` and `unblock()`.
+
+    When the last runnable task blocks or finishes while tasks are blocked, nothing can unblock them, and `deadlock` is set with a description.
+    `on_block` is called whenever a task blocks.
+    '''
+
+    def __init__(self, deadlock = None, on_block = None):
+        self.deadlock = deadlock
+        self.on_block = on_block
+        self.runnable = set()
+        self.blocked = {}
+
+    def start(self, task):
+        self.runnable.add(task)
+
+    def finished(self, task):
+        self.runnable.discard(task)
+        self._check()
+
+    def block(self, task, reason, on = None):
+        '''Report that `task` is blocked for `reason`.
+
+        `on` is the task expected to unblock it, or a callable returning it, and is used to describe dependency cycles.
+        '''
+
+        self.runnable.discard(task)
+        self.blocked[task] = (reason, on)
+        self._check()
+
+        if self.on_block is not None:
+            self.on_block()
+
+    def unblock(self, task):
+        if self.blocked.pop(task, None) is not None:
+            self.runnable.add(task)
+
+    def _check(self):
+        if self.runnable or not self.blocked or self.deadlock is None or self.deadlock.done():
+            return
+
+        self.deadlock.set_result(self.describe())
+
+    def _provider(self, task):
+        on = self.blocked[task][1]
+        return on() if callable(on) else on
+
+    def _cycle(self):
+        for start in self.blocked:
+            path = [start]
+            task = self._provider(start)
+            while task in self.blocked and task not in path:
+                path.append(task)
+                task = self._provider(task)
+            if task is not None and task in path:
+                return path[path.index(task):]
+
+    def describe(self):
+        lines = ['All remaining tasks are blocked:']
+
+        cycle = self._cycle()
+        if cycle:
+            lines.append('Cycle: ' + ' -> '.join(f'{task.id.str} ({self.blocked[task][0]})' for task in cycle) + f' -> {cycle[0].id.str}')
+
+        for task, (reason, _) in self.blocked.items():
+            provider = self._provider(task)
+            lines.append(f'  {task.id.str}: {reason}' + (f', provided by {provider.id.str}' if provider is not None else ', not provided by any running task'))
+
+        return '\n'.join(lines)
@@ -0,0 +1,48 @@
+def print_stats(ctx):
+    cache = ctx.cache
+    fingerprints = ctx.fingerprints
+    artifacts = ctx.artifacts
+
+    print(f'Cache: {len(cache)} entries, {cache.size() / 1024:.1f} kB, loaded in {cache.load_time * 1000:.1f} ms')
+    print(f'Fingerprint cache: {fingerprints.stat_misses} stats ({fingerprints.stat_hits} hits), {fingerprints.hash_misses} hashes ({fingerprints.hash_hits} hits)')
+    print(f'Clean tasks skipped before scheduling: {ctx.skipped}')
+
+    engine = ctx.engine
+    if engine is not None and engine.order:
+        print(f'Engine: {len(engine.order)} tasks scheduled, {engine.overhead / len(engine.order) * 1e6:.1f} us/task overhead, {engine.workers} workers')
+    print(f'Early cutoff: {fingerprints.restats} unchanged outputs, {ctx.cutoffs} tasks not rerun')
+
+    remote = ctx.remote_executor
+    if remote:
+        print(f'Remote workers: {len(remote.workers)} with {remote.capacity} jobs, {remote.jobs} commands run, {remote.failures} failures')
+
+    if artifacts:
+        print(f'Artifact cache: {artifacts.hits} hits, {artifacts.misses} misses, {artifacts.stores} stored')
+
+        if artifacts.remote:
+            print(f'Remote cache: {artifacts.remote_hits} fetched, {artifacts.uploads} uploaded, {artifacts.remote.errors} errors')
+
+_metrics = [
+    ('CPU time', lambda r: r['user_time'] + r['system_time']),
+    ('max RSS', lambda r: r['max_rss']),
+    ('block I/O', lambda r: r['read_blocks'] + r['written_blocks']),
+]
+
+def print_top_tasks(ctx, count):
+    '''Print the `count` tasks with the highest CPU time, memory and I/O usage of their subprocesses.
+
+    Usage is taken from the cache, so tasks that didn't run in this build show their last run.
+    '''
+
+    usage = {}
+    for id, task in ctx.tasks.items():
+        resources = ctx.cache.get(id.mangled, {}).get('resources')
+        if resources:
+            usage[task] = resources
+
+    for name, metric in _metrics:
+        print(f'Top {count} tasks by {name}:')
+        print(f'  {"user":>8} {"sys":>8} {"max RSS":>10} {"blocks in":>10} {"blocks out":>10}  task')
+        for task in sorted(usage, key = lambda task: metric(usage[task]), reverse = True)[:count]:
+            r = usage[task]
+            print(f'  {r["user_time"]:7.2f}s {r["system_time"]:7.2f}s {r["max_rss"] / 1024:8.1f}MB {r["read_blocks"]:10} {r["written_blocks"]:10}  {task.id.str}')
@@ -1,11 +1,98 @@
 import pathlib
 import asyncio
+import functools
+import hashlib
+import json
+import os
+import shutil
 
 from ... import core
+from ...util.depfile import parse_depfile
 from ...util.subprocess import subprocess
 from .module_mapper import ModuleMapper
 
-__all__ = ['Compile', 'Link']
+__all__ = ['Archive', 'Compile', 'Link', 'PrecompiledHeader', 'ScanDeps', 'UnitySource']
+
+@functools.cache
+def _tool_identity(tool):
+    path = shutil.which(tool)
+    if path is None:
+        return tool
+
+    st = pathlib.Path(path).stat()
+    return (str(pathlib.Path(path).resolve()), st.st_size, st.st_mtime_ns)
+
+def _unity_batches(source_files, unity):
+    '''Group `source_files` into batches for a unity build.
+
+    Sources are grouped by directory and language, and each group is split into batches of about `unity` sources, or kept whole if `unity` is `'directory'`.
+    Sources are put in batches by a hash of their name, so adding or removing one only changes its own batch.
+    The number of batches in a group is a power of two, so that only changes when a group doubles or halves in size.
+    '''
+
+    if unity != 'directory' and not (isinstance(unity, int) and unity > 0):
+        raise ValueError(f'Unity batch size must be a positive integer or \'directory\', not {unity!r}')
+
+    groups = {}
+    for f in sorted(source_files):
+        groups.setdefault((f.parent, f.suffix), []).append(f)
+
+    for (directory, suffix), files in sorted(groups.items()):
+        count = 1
+        while unity != 'directory' and count * unity < len(files):
+            count *= 2
+
+        batches = {}
+        for f in files:
+            batch = int.from_bytes(hashlib.blake2b(f.name.encode('utf-8'), digest_size = 8).digest(), 'little') % count
+            batches.setdefault(batch, []).append(f)
+
+        for batch, files in sorted(batches.items()):
+            yield directory / f'unity{batch}{suffix}', files
+
+def _object_file(env, source_file):
+    'Object file for `source_file`, next to it for sources generated in the build directory.'
+
+    if source_file.is_relative_to(env.build_dir):
+        return source_file.with_suffix('.o')
+    return env.build_dir / 'objects' / source_file.with_suffix('.o')
+
+def _pch_include_name(header):
+    'Path of the forwarding header for `header` within the PCH directory, under a hash of the header\'s directory when it\'s outside the source tree.'
+
+    try:
+        path = pathlib.Path(os.path.relpath(os.path.abspath(header)))
+    except ValueError:
+        # On another drive than the working directory.
+        path = pathlib.Path(header)
+    if path.is_absolute() or '..' in path.parts:
+        digest = hashlib.blake2b(os.path.dirname(os.path.abspath(header)).encode('utf-8'), digest_size = 8).hexdigest()
+        return pathlib.Path(digest) / path.name
+    return path
+
+def _is_module_path(env, path):
+    'Whether `path` is a compiled module interface, which compiles add to their outputs once they know the modules they export.'
+
+    return env.module_mapper is not None and path.parent == env.module_mapper.cmi_dir and path.suffix == '.gcm'
+
+def _compile_tasks(env, target, source_files, unity):
+    'Compile tasks for the sources of `target`, in unity batches if `unity` is set.'
+
+    if unity is None:
+        return [Compile(env, f) for f in source_files]
+
+    if env.module_mapper is not None:
+        raise ValueError('Unity builds can\'t be used together with C++ modules')
+
+    # A batch of one source is compiled as is.
+    tasks = []
+    for unity_file, batch in _unity_batches(source_files, unity):
+        if len(batch) == 1:
+            tasks.append(Compile(env, batch[0]))
+        else:
+            unity_task = UnitySource(env, env.build_dir / 'unity' / target / unity_file, batch)
+            tasks.append(Compile(env, unity_task.target))
+    return tasks
 
 class Env(core.Env):
     toolchain_prefix: str
@@ -29,7 +116,7 @@ class Env(core.Env):
     libs: list[str]
     'Libraries'
 
-    def __init__(self, *, cxx_modules = False, **kwargs):
+    def __init__(self, *, cxx_modules = False, scan_module_deps = False, **kwargs):
         super().__init__(**kwargs)
 
         self.toolchain_prefix = ''
@@ -41,13 +128,24 @@ class Env(core.Env):
         self.include_path = []
         self.lib_path = []
         self.libs = []
+        self.precompiled_headers = []
 
         if cxx_modules:
             self.module_mapper = ModuleMapper(self, self.build_dir / 'cmi')
             self.ctx.start_async(self.module_mapper.start())
+            self.ctx.stop_async(self.module_mapper.stop)
         else:
             self.module_mapper = None
 
+        if scan_module_deps and not cxx_modules:
+            raise ValueError('Scanning module dependencies requires C++ modules')
+        self.scan_module_deps = scan_module_deps
+
+    def tool(self, name):
+        'Name of toolchain executable `name`, with prefix and suffix applied.'
+
+        return f'{self.toolchain_prefix}{name}{self.toolchain_suffix}'
+
     def _task_from_ident(self, ident):
         if ident.endswith('.cpp'):
             return self.ctx.tasks.get(core.TaskID('compile', self.build_dir, ident))
@@ -55,14 +153,49 @@ class Env(core.Env):
             return self.ctx.tasks.get(core.TaskID('header_module', self.build_dir, ident))
 
     def executable(self, output_file, source_files, **kwargs):
+        '''Link an executable from `source_files`.
+
+        Pass `unity` to compile sources in batches, as a batch size or `'directory'` for a batch per directory.
+        Pass `libraries` to link static libraries created by `static_library()`.
+        '''
+
         return Link(self, output_file, [pathlib.Path(f) for f in source_files], **kwargs)
 
+    def static_library(self, output_file, source_files, **kwargs):
+        '''Archive the objects of `source_files` into a static library.
+
+        Pass `thin = True` for a thin archive, which refers to the objects instead of containing copies of them.
+        Pass `unity` to compile sources in batches, like for `executable()`.
+        '''
+
+        return Archive(self, output_file, [pathlib.Path(f) for f in source_files], **kwargs)
+
     def header_module(self, header):
         return HeaderModule(self, header)
 
+    def precompiled_header(self, header):
+        'Precompile `header` and include it in every C++ source compiled in this environment.'
+
+        if self.module_mapper is not None:
+            raise ValueError('Precompiled headers can\'t be used together with C++ modules')
+
+        task = PrecompiledHeader(self, pathlib.Path(header))
+        if task in self.precompiled_headers:
+            return task
+        self.precompiled_headers.append(task)
+
+        # Sources added before the header depend on it as well.
+        for t in self.ctx.tasks.values():
+            if isinstance(t, Compile) and t.env is self and t.source_file.suffix != '.c':
+                t.add_input_files(task.gch_file)
+
+        return task
+
 class Compile(core.Task):
     env: Env
 
+    artifact_cacheable = True
+
     def __new__(cls, env, source_file):
         try:
             self = super().__new__(cls, env.ctx, ('compile', env.build_dir, source_file))
@@ -73,13 +206,24 @@ class Compile(core.Task):
 
         self.env = env
         self.source_file = source_file
-        self.object_file = self.env.build_dir / 'objects' / source_file.with_suffix('.o')
+        self.object_file = _object_file(self.env, source_file)
         self._modules_required = []
         self._modules_generated = []
         self.add_input_files(source_file)
         self.add_output_files(self.object_file)
+        self.add_input_files(*(pch.gch_file for pch in self._precompiled_headers()))
+
+        # Scanning ahead lets the compile wait for the modules it imports before it starts.
+        if self.env.scan_module_deps and source_file.suffix != '.c':
+            self.scan_task = ScanDeps(env, source_file)
+            self.add_input_files(self.scan_task.ddi_file)
+        else:
+            self.scan_task = None
         return self
 
+    def _precompiled_headers(self):
+        return [] if self.source_file.suffix == '.c' else self.env.precompiled_headers
+
     def input_metadata(self):
         return super().input_metadata() | {
             'toolchain_prefix': self.env.toolchain_prefix,
@@ -87,16 +231,46 @@ class Compile(core.Task):
             'flags': self.env.cflags if self.source_file.suffix == '.c' else self.env.cxxflags,
             'defines': self.env.defines,
             'include_path': self.env.include_path,
+            'precompiled_headers': [pch.header for pch in self._precompiled_headers()],
         }
 
+    @property
+    def compiler(self):
+        return self.env.tool('gcc' if self.source_file.suffix == '.c' else 'g++')
+
+    def toolchain_identity(self):
+        return _tool_identity(self.compiler)
+
+    def artifact_root(self):
+        return self.env.build_dir
+
+    def artifact_outputs(self):
+        dep_file = self.object_file.with_suffix('.d')
+        return super().artifact_outputs() + ([dep_file] if dep_file.exists() else [])
+
+    def artifact_restorable(self, path):
+        return super().artifact_restorable(path) or path == self.object_file.with_suffix('.d') or _is_module_path(self.env, path)
+
+    def skippable_when_clean(self):
+        # Without modules, the hooks don't do anything for up to date tasks.
+        return self.env.module_mapper is None
+
     async def pre_run(self):
+        if self.env.module_mapper is None:
+            return
+
+        # Wait for scanned imports without holding a task slot, so no compiler is kept waiting for them.
+        if self.scan_task is not None:
+            for module in self.scan_task.result['requires']:
+                await self.env.module_mapper.registry.module_required(module, self)
+
         # Do an early up-to-date check.
-        if self._uptodate():
+        if await self._uptodate():
             cache = self.ctx.cache[self.id.mangled]
 
             # If the early check indicates we're up to date, ensure all required modules are (re-)built before we proceed to the actual check.
             for module in cache['result']['modules_required']:
-                await self.env.module_mapper.registry.module_required(module)
+                await self.env.module_mapper.registry.module_required(module, self)
 
     async def run(self):
         source_file = self.source_file
@@ -108,11 +282,9 @@ class Compile(core.Task):
         object_file.parent.mkdir(parents = True, exist_ok = True)
 
         if source_file.suffix == '.c':
-            compiler = f'{self.env.toolchain_prefix}gcc{self.env.toolchain_suffix}'
             flags = self.env.cflags.copy()
 
         else:
-            compiler = f'{self.env.toolchain_prefix}g++{self.env.toolchain_suffix}'
             flags = self.env.cxxflags.copy()
             if self.env.module_mapper is not None:
                 flags.extend([
@@ -120,20 +292,53 @@ class Compile(core.Task):
                     self.env.module_mapper.gcc_arg(source_file),
                 ])
 
+        preprocessor_flags = []
         for define in self.env.defines:
-            flags.extend(['-D', define])
+            preprocessor_flags.extend(['-D', define])
         for path in self.env.include_path:
-            flags.extend(['-I', path])
+            preprocessor_flags.extend(['-I', path])
+        for pch in self._precompiled_headers():
+            preprocessor_flags.extend(['-Winvalid-pch', '-include', pch.include_file])
+
+        # Without modules, the compile can be offloaded to a remote worker.
+        # Preprocessing is done locally first, so the worker doesn't need any headers.
+        if self.ctx.remote_executor is not None and self.env.module_mapper is None:
+            preprocessed_file = object_file.with_suffix('.i' if source_file.suffix == '.c' else '.ii')
+
+            await subprocess([
+                self.compiler,
+                *flags,
+                *preprocessor_flags,
+                '-E',
+                source_file,
+                '-o', preprocessed_file,
+                '-MMD',
+                '-MF', dep_file,
+                '-MT', object_file,
+            ])
+
+            try:
+                await subprocess([
+                    self.compiler,
+                    *flags,
+                    '-c',
+                    preprocessed_file,
+                    '-o', object_file,
+                ], inputs = [preprocessed_file], outputs = [object_file], remote = True)
+            finally:
+                preprocessed_file.unlink(missing_ok = True)
 
-        await subprocess([
-            compiler,
-            *flags,
-            '-c',
-            source_file,
-            '-o', object_file,
-            '-MMD',
-            '-MF', dep_file,
-        ])
+        else:
+            await subprocess([
+                self.compiler,
+                *flags,
+                *preprocessor_flags,
+                '-c',
+                source_file,
+                '-o', object_file,
+                '-MMD',
+                '-MF', dep_file,
+            ])
 
         if not dep_file.exists():
             return {
@@ -141,29 +346,13 @@ class Compile(core.Task):
                 'modules_generated': self._modules_generated,
             }
 
-        depmap = {}
-
-        with open(dep_file) as f:
-            contents = f.read().replace('\\\n', ' ')
-            for line in contents.split('\n'):
-                if line.count(':') != 1:
-                    continue
-                targets, deps = line.split(':')
-                targets = targets.split()
-                deps = deps.replace('|', '').split()
-
-                for t in targets:
-                    if t not in depmap:
-                        depmap[t] = []
-                    depmap[t].extend(deps)
-
         file_deps = []
 
-        for f in depmap[str(object_file)]:
-            if f.endswith('.c++m'):
-                continue
-
-            file_deps.append(pathlib.Path(f))
+        # Only the rule for the object file lists its inputs, the others are for modules and phony headers.
+        with open(dep_file) as f:
+            for targets, deps in parse_depfile(f):
+                if str(object_file) in targets:
+                    file_deps.extend(pathlib.Path(os.path.normpath(d)) for d in deps if not d.endswith('.c++m'))
 
         # Add included files as input files to trigger a rerun of this task if any changes in the future.
         self.add_input_files(*(f for f in file_deps if f != source_file))
@@ -177,15 +366,114 @@ class Compile(core.Task):
         }
 
     async def post_run(self):
+        if self.env.module_mapper is None:
+            return
+
         # Report that modules are built.
         registry = self.env.module_mapper.registry
         for m in self.result['modules_generated']:
             if not registry.module_exists(m):
                 registry.module_provided(m)
 
+class ScanDeps(core.Task):
+    '''Scans a C++ source for the named modules it provides and requires, using GCC's P1689 dependency output.
+
+    This needs GCC 14 or later, and is enabled by `Env(cxx_modules = True, scan_module_deps = True)`.
+    Header units aren't scanned, and are still resolved through the module mapper while compiling.
+    '''
+
+    env: Env
+
+    def __new__(cls, env, source_file):
+        try:
+            self = super().__new__(cls, env.ctx, ('scan_deps', env.build_dir, source_file))
+        except core.TaskExists as e:
+            if e.task.env == env:
+                return e.task
+            raise
+
+        self.env = env
+        self.source_file = source_file
+        self.object_file = _object_file(self.env, source_file)
+        self.ddi_file = self.object_file.with_suffix('.ddi')
+        self.add_input_files(source_file)
+        self.add_output_files(self.ddi_file)
+        return self
+
+    def input_metadata(self):
+        return super().input_metadata() | {
+            'toolchain_prefix': self.env.toolchain_prefix,
+            'toolchain_suffix': self.env.toolchain_suffix,
+            'flags': self.env.cxxflags,
+            'defines': self.env.defines,
+            'include_path': self.env.include_path,
+        }
+
+    def toolchain_identity(self):
+        return _tool_identity(self.env.tool('g++'))
+
+    def skippable_when_clean(self):
+        # Exporters are registered in `post_run()`.
+        return False
+
+    async def run(self):
+        ddi_file = self.ddi_file
+        dep_file = self.object_file.with_suffix('.scan.d')
+
+        # Ensure output directory exists.
+        ddi_file.parent.mkdir(parents = True, exist_ok = True)
+
+        flags = self.env.cxxflags.copy()
+        for define in self.env.defines:
+            flags.extend(['-D', define])
+        for path in self.env.include_path:
+            flags.extend(['-I', path])
+
+        await subprocess([
+            self.env.tool('g++'),
+            *flags,
+            '-fmodules-ts',
+            '-E',
+            '-x', 'c++',
+            self.source_file,
+            '-o', os.devnull,
+            '-MMD',
+            '-MF', dep_file,
+            '-MT', ddi_file,
+            '-fdeps-format=p1689r5',
+            f'-fdeps-file={ddi_file}',
+            f'-fdeps-target={self.object_file}',
+        ])
+
+        file_deps = []
+        with open(dep_file) as f:
+            for targets, deps in parse_depfile(f):
+                if str(ddi_file) in targets:
+                    file_deps.extend(pathlib.Path(os.path.normpath(d)) for d in deps if not d.endswith('.c++m'))
+
+        # Imports may be in included files too.
+        self.add_input_files(*(f for f in file_deps if f != self.source_file))
+
+        with open(ddi_file) as f:
+            rules = json.load(f)['rules']
+
+        # Requirements with a lookup method are header units.
+        return {
+            'provides': [p['logical-name'] for rule in rules for p in rule.get('provides', [])],
+            'requires': [r['logical-name'] for rule in rules for r in rule.get('requires', []) if 'lookup-method' not in r],
+        }
+
+    async def post_run(self):
+        # Let the registry know who builds each module before its importers wait for it, for deadlock reports.
+        compile_task = self.ctx.tasks.get(core.TaskID('compile', self.env.build_dir, self.source_file))
+        for module in self.result['provides']:
+            self.env.module_mapper.registry.module_exported(module, compile_task)
+
 class HeaderModule(core.Task):
     env: Env
 
+    artifact_cacheable = True
+
     def __new__(cls, env, header):
         try:
             self = super().__new__(cls, env.ctx, ('header_module', env.build_dir, header))
@@ -197,6 +485,10 @@ class HeaderModule(core.Task):
         self.env = env
         self.header = header
         self._modules_generated = []
+
+        # Track the header itself when it's a file rather than a system header name.
+        if pathlib.Path(header).is_file():
+            self.add_input_files(header)
         return self
 
     def input_metadata(self):
@@ -208,12 +500,20 @@ class HeaderModule(core.Task):
             'include_path': self.env.include_path,
         }
 
+    def toolchain_identity(self):
+        return _tool_identity(self.env.tool('g++'))
+
+    def artifact_root(self):
+        return self.env.build_dir
+
+    def artifact_restorable(self, path):
+        return super().artifact_restorable(path) or _is_module_path(self.env, path)
+
     async def run(self):
         cmi_dir = self.env.build_dir / 'cmi'
 
         assert self.env.module_mapper is not None
 
-        compiler = f'{self.env.toolchain_prefix}g++{self.env.toolchain_suffix}'
         flags = self.env.cxxflags.copy()
         flags.extend([
             '-fmodules-ts',
@@ -226,7 +526,7 @@ class HeaderModule(core.Task):
             flags.extend(['-I', path])
 
         await subprocess([
-            compiler,
+            self.env.tool('g++'),
             *flags,
             '-x', 'c++-user-header',
             '-c',
@@ -247,19 +547,152 @@ class HeaderModule(core.Task):
             if not registry.module_exists(m):
                 registry.module_provided(m)
 
+class PrecompiledHeader(core.Task):
+    '''Precompiles a header with the C++ flags of an environment.
+
+    Sources include a forwarding header next to the `.gch`, which GCC replaces with the `.gch` when it's valid for the compile.
+    Compiles pass `-Winvalid-pch`, so a `.gch` that can't be used is reported rather than silently ignored.
+    '''
+
+    env: Env
+
+    artifact_cacheable = True
+
+    def __new__(cls, env, header):
+        try:
+            self = super().__new__(cls, env.ctx, ('precompiled_header', env.build_dir, header))
+        except core.TaskExists as e:
+            if e.task.env == env:
+                return e.task
+            raise
+
+        self.env = env
+        self.header = header
+        self.include_file = self.env.build_dir / 'pch' / _pch_include_name(header)
+        self.gch_file = self.include_file.with_name(f'{self.include_file.name}.gch')
+        self.add_input_files(header)
+        self.add_output_files(self.include_file, self.gch_file)
+        return self
+
+    def input_metadata(self):
+        return super().input_metadata() | {
+            'toolchain_prefix': self.env.toolchain_prefix,
+            'toolchain_suffix': self.env.toolchain_suffix,
+            'flags': self.env.cxxflags,
+            'defines': self.env.defines,
+            'include_path': self.env.include_path,
+        }
+
+    def toolchain_identity(self):
+        return _tool_identity(self.env.tool('g++'))
+
+    def artifact_root(self):
+        return self.env.build_dir
+
+    def artifact_outputs(self):
+        dep_file = self.gch_file.with_suffix('.d')
+        return super().artifact_outputs() + ([dep_file] if dep_file.exists() else [])
+
+    def artifact_restorable(self, path):
+        return super().artifact_restorable(path) or path == self.gch_file.with_suffix('.d')
+
+    async def run(self):
+        include_file = self.include_file
+        gch_file = self.gch_file
+        dep_file = gch_file.with_suffix('.d')
+
+        # Ensure output directory exists.
+        include_file.parent.mkdir(parents = True, exist_ok = True)
+
+        # The forwarding header is what gets precompiled, so the header itself isn't the main file, which would make GCC warn about `#pragma once`.
+        include_file.write_text(f'#include "{os.path.relpath(self.header, include_file.parent)}"\n')
+
+        flags = self.env.cxxflags.copy()
+        for define in self.env.defines:
+            flags.extend(['-D', define])
+        for path in self.env.include_path:
+            flags.extend(['-I', path])
+
+        await subprocess([
+            self.env.tool('g++'),
+            *flags,
+            '-x', 'c++-header',
+            include_file,
+            '-o', gch_file,
+            '-MMD',
+            '-MF', dep_file,
+            '-MT', gch_file,
+        ])
+
+        file_deps = []
+        with open(dep_file) as f:
+            for targets, deps in parse_depfile(f):
+                if str(gch_file) in targets:
+                    file_deps.extend(pathlib.Path(os.path.normpath(d)) for d in deps)
+
+        # Add included files as input files to trigger a rerun of this task if any changes in the future.
+        self.add_input_files(*(f for f in file_deps if f not in (include_file, self.header)))
+
+        return gch_file
+
+class UnitySource(core.Task):
+    'Generates a source file including a batch of sources, so they are compiled as a single translation unit.'
+
+    env: Env
+
+    def __new__(cls, env, target, source_files):
+        self = super().__new__(cls, env.ctx, ('unity', env.build_dir, target))
+        self.env = env
+        self.target = target
+        self.source_files = source_files
+        self.add_output_files(target)
+        return self
+
+    def input_metadata(self):
+        return super().input_metadata() | {
+            'source_files': self.source_files,
+        }
+
+    async def run(self):
+        output = ''.join(f'#include "{os.path.relpath(f, self.target.parent)}"\n' for f in self.source_files)
+
+        # Leave the output untouched if it didn't change, so the batch isn't recompiled.
+        try:
+            if self.target.read_text() == output:
+                return
+        except FileNotFoundError:
+            pass
+
+        # Ensure output directory exists.
+        self.target.parent.mkdir(parents = True, exist_ok = True)
+
+        with open(self.target, 'w') as f:
+            f.write(output)
+
 class Link(core.Task):
     env: Env
 
-    def __new__(cls, env, target, source_files, ld_script = None):
+    artifact_cacheable = True
+    pool = 'link'
+
+    def __new__(cls, env, target, source_files, ld_script = None, unity = None, libraries = []):
         self = super().__new__(cls, env.ctx, ('link', env.build_dir, target))
         self.env = env
         self.target = target
         self.source_files = source_files,
-        self.object_tasks = [Compile(env, f) for f in source_files]
+        self.unity = unity
         self.ld_script = ld_script
+        self.libraries = list(libraries)
+        self.object_tasks = _compile_tasks(env, target, source_files, unity)
         #self.dependencies.extend(self.object_tasks) # This is added implicitly through input_files
         self.elf_file = self.env.build_dir / self.target
         self.add_input_files(*(t.object_file for t in self.object_tasks))
+        for lib in self.libraries:
+            self.add_input_files(lib.archive_file)
+
+            # A thin archive only refers to its members, so it's unchanged when they change.
+            if lib.thin:
+                self.add_input_files(*(t.object_file for t in lib.object_tasks))
         self.add_output_files(self.elf_file)
         if self.ld_script is not None:
             self.add_input_files(self.ld_script)
@@ -270,6 +703,8 @@ class Link(core.Task):
             'toolchain_prefix': self.env.toolchain_prefix,
             'toolchain_suffix': self.env.toolchain_suffix,
             'source_files': self.source_files,
+            'unity': self.unity,
+            'libraries': [lib.archive_file for lib in self.libraries],
             'ld_script': self.ld_script,
             'toolchain': self.env.toolchain_prefix,
             'flags': self.env.ldflags,
@@ -277,6 +712,12 @@ class Link(core.Task):
             'libs': self.env.libs,
         }
 
+    def toolchain_identity(self):
+        return _tool_identity(self.env.tool('g++'))
+
+    def artifact_root(self):
+        return self.env.build_dir
+
     async def run(self):
         object_files_str = ' '.join(str(t.object_file) for t in self.object_tasks)
         elf_file = self.elf_file
@@ -293,11 +734,91 @@ class Link(core.Task):
             ldflags.extend(['-T', self.ld_script])
 
         await subprocess([
-            f'{self.env.toolchain_prefix}g++{self.env.toolchain_suffix}',
+            self.env.tool('g++'),
             *ldflags,
             *(str(t.object_file) for t in self.object_tasks),
+            *(lib.archive_file for lib in self.libraries),
             '-o', elf_file,
             *(f'-l{lib}' for lib in self.env.libs),
         ])
 
         return elf_file
+
+class Archive(core.Task):
+    '''Archives objects into a static library.
+
+    When only some objects changed since the last run, only those members are replaced, and members of removed sources are deleted.
+    Members are stored by path, so objects with the same name in different directories don't replace each other.
+    '''
+
+    env: Env
+
+    artifact_cacheable = True
+
+    def __new__(cls, env, target, source_files, thin = False, unity = None):
+        self = super().__new__(cls, env.ctx, ('archive', env.build_dir, target))
+        self.env = env
+        self.target = target
+        self.source_files = source_files
+        self.thin = thin
+        self.unity = unity
+        self.object_tasks = _compile_tasks(env, target, source_files, unity)
+        self.archive_file = self.env.build_dir / self.target
+        self.add_input_files(*(t.object_file for t in self.object_tasks))
+        self.add_output_files(self.archive_file)
+        return self
+
+    def input_metadata(self):
+        return super().input_metadata() | {
+            'toolchain_prefix': self.env.toolchain_prefix,
+            'toolchain_suffix': self.env.toolchain_suffix,
+            'source_files': self.source_files,
+            'thin': self.thin,
+            'unity': self.unity,
+        }
+
+    def toolchain_identity(self):
+        return _tool_identity(self.env.tool('ar'))
+
+    def artifact_root(self):
+        return self.env.build_dir
+
+    async def _changed_members(self, members):
+        '''Members that changed since the archive was last written, and members that were removed, or None if it has to be recreated.'''
+
+        previous = self.ctx.cache.get(self.id.mangled)
+        if previous is None or not self.archive_file.exists() or previous['result']['thin'] != self.thin:
+            return None
+
+        fingerprints = previous.get('file_fingerprints', {})
+        current = await asyncio.gather(*(self.ctx.fingerprints.fingerprint(path) for path in members))
+        changed = [path for path, fingerprint in zip(members, current) if path not in fingerprints or fingerprints[path].hash != fingerprint.hash]
+        removed = [path for path in previous['result']['members'] if path not in members]
+        return changed, removed
+
+    async def run(self):
+        archive_file = self.archive_file
+        members = [t.object_file for t in self.object_tasks]
+
+        # Ensure output directory exists.
+        archive_file.parent.mkdir(parents = True, exist_ok = True)
+
+        # Deterministic mode keeps the archive identical when its members are, so dependents can be cut off.
+        modifiers = 'csDP' + ('T' if self.thin else '')
+
+        changes = await self._changed_members(members)
+        if changes is None:
+            archive_file.unlink(missing_ok = True)
+            changed, removed = members, []
+        else:
+            changed, removed = changes
+
+        if removed:
+            await subprocess([self.env.tool('ar'), 'dsDP', archive_file, *removed])
+        if changed:
+            await subprocess([self.env.tool('ar'), f'r{modifiers}', archive_file, *changed])
+
+        return {
+            'members': members,
+            'thin': self.thin,
+        }
@@ -1,8 +1,14 @@
 import asyncio
+import pathlib
+import socket
+import tempfile
 
 class ModuleRegistry:
-    def __init__(self):
+    def __init__(self, ctx):
+        self.ctx = ctx
         self.modules = {}
+        self.exporters = {}
+        self.importers = {}
 
     def _module_future(self, name):
         if not name in self.modules:
@@ -10,10 +16,31 @@ class ModuleRegistry:
 
         return self.modules[name]
 
-    async def module_required(self, name):
-        await self._module_future(name)
+    async def module_required(self, name, task = None):
+        future = self._module_future(name)
+
+        if future.done() or task is None:
+            await future
+            return
+
+        # Report the wait, so a deadlock is detected if nothing is left to build the module.
+        self.ctx.tracker.block(task, f'importing module {name}', on = lambda: self.exporters.get(name))
+        self.importers.setdefault(name, set()).add(task)
+        try:
+            with task._trace(f'import {name}', 'module'):
+                await future
+        finally:
+            self.importers[name].discard(task)
+            self.ctx.tracker.unblock(task)
+
+    def module_exported(self, name, task):
+        self.exporters[name] = task
 
     def module_provided(self, name):
+        # Importers are runnable from now on, not only once they resume.
+        for task in self.importers.get(name, ()):
+            self.ctx.tracker.unblock(task)
+
         self._module_future(name).set_result(None)
 
     def module_exists(self, name):
@@ -29,12 +56,13 @@ class Handler:
     async def read(self):
         while line := await self.reader.readline():
             #print(f'< {line!r}', file=sys.stderr)
-            yield tuple(line.decode('utf-8').strip().split())
+            if command := tuple(line.decode('utf-8').split()):
+                yield command
 
-    def write(self, line):
-        line = line + '\n'
-        self.writer.write(line.encode('utf-8'))
-        #print(f'> {line!r}', file=sys.stderr)
+    def write(self, lines):
+        # A block of replies goes out in a single write, with every reply but the last continued by `;`.
+        self.writer.write((' ;\n'.join(lines) + '\n').encode('utf-8'))
+        #print(f'> {lines!r}', file=sys.stderr)
 
     async def handle(self, command):
         match command:
@@ -46,13 +74,15 @@ class Handler:
                 return f'PATHNAME {self.mapper.cmi_dir}'
 
             case ('MODULE-EXPORT', module, *_):
+                if self.task:
+                    self.mapper.registry.module_exported(module, self.task)
                 return f'PATHNAME {self.mapper.gcm_name(module)}'
 
             case ('MODULE-IMPORT', module, *_):
                 assert self.task is not None
                 self.task._modules_required.append(module)
                 async with self.task.mark_suspended():
-                    await self.mapper.registry.module_required(module)
+                    await self.mapper.registry.module_required(module, self.task)
                 return f'PATHNAME {self.mapper.gcm_name(module)}'
 
             case ('MODULE-COMPILED', module):
@@ -69,16 +99,16 @@ class Handler:
 
     async def run(self):
         try:
-            command_queue = []
-            async for line in self.read():
-                command_queue.append(line)
-                if command_queue[-1][-1] == ';':
-                    *command_queue[-1], _ = command_queue[-1]
+            block = []
+            async for command in self.read():
+                # Commands ending with `;` are continued by the next one, and the block is answered as a whole.
+                if command[-1] == ';':
+                    block.append(command[:-1])
                     continue
+                block.append(command)
 
-                while len(command_queue) > 1:
-                    self.write(await self.handle(command_queue.pop(0)) + ' ;')
-                self.write(await self.handle(command_queue.pop(0)))
+                self.write([await self.handle(c) for c in block])
+                block = []
                 await self.writer.drain()
         finally:
             self.writer.close()
@@ -87,18 +117,54 @@ class ModuleMapper:
     def __init__(self, env, cmi_dir):
         self.env = env
         self.cmi_dir = cmi_dir
-        self.registry = ModuleRegistry()
+        self.registry = ModuleRegistry(env.ctx)
         self.port = None
+        self.socket_path = None
+        self._socket_dir = None
+        self._server = None
+        self._handlers = set()
 
     async def _handle_client(self, reader, writer):
         m = Handler(self, reader, writer)
-        await m.run()
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            await m.run()
+        except asyncio.CancelledError:
+            # The stream server reports connections that end cancelled as errors, while this is how `stop()` ends them.
+            pass
+        finally:
+            self._handlers.discard(task)
 
     async def start(self):
-        server = await asyncio.start_server(self._handle_client, host = '::1', port = None)
-        self.port = server.sockets[0].getsockname()[1]
+        # Unix domain sockets save the TCP overhead on every round trip, TCP is only used where they aren't available.
+        if hasattr(socket, 'AF_UNIX'):
+            self._socket_dir = tempfile.TemporaryDirectory(prefix = 'erect-')
+            self.socket_path = pathlib.Path(self._socket_dir.name) / 'module-mapper.sock'
+            self._server = await asyncio.start_unix_server(self._handle_client, self.socket_path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host = '::1', port = None)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        'Stop serving and end open connections, like those of compiles still waiting for modules when a build is aborted.'
+
+        if self._server is not None:
+            self._server.close()
+
+        for handler in self._handlers:
+            handler.cancel()
+        await asyncio.gather(*self._handlers, return_exceptions = True)
+
+        if self._socket_dir is not None:
+            self._socket_dir.cleanup()
+            self._socket_dir = None
+            self.socket_path = None
 
     def gcc_arg(self, ident):
+        if self.socket_path is not None:
+            return f'-fmodule-mapper=={self.socket_path}?{ident}'
+
         assert self.port is not None
         return f'-fmodule-mapper=localhost:{self.port}?{ident}'
 
@@ -1,6 +1,7 @@
 from ..core.task import Task
 from ..core.env import Env
 
+import asyncio
 import pathlib
 import jinja2
 
@@ -21,6 +22,14 @@ jinja2_env.filters['hex'] = lambda value: '%#x' % value
 jinja2_env.filters['size_prefix'] = lambda value: '%d%s' % next((value / 1024**i, c) for i, c in [(2, 'M'), (1, 'k'), (0, '')] if value % 1024**i == 0)
 
 class Jinja2(Task):
+    '''Renders a template with `jinja2_env`.
+
+    Templates are rendered in a thread, which sees any filters, tests and globals a blueprint adds to `jinja2_env`.
+    Setting `cpu_bound` on a task or subclass renders it in a worker process instead, which only sees `jinja2_env` as set up by this module.
+    '''
+
+    artifact_cacheable = True
+
     def __new__(cls, env, target, source, **kwargs):
         self = super().__new__(cls, env.ctx, ('jinja2', env.build_dir, target))
         self.env = env
@@ -37,15 +46,33 @@ class Jinja2(Task):
             'data': self.data,
         }
 
+    def artifact_root(self):
+        return self.env.build_dir
+
     async def run(self):
         print(self.id.str)
 
-        template = jinja2_env.get_template(str(self.source))
-        output = template.render(**self.data) + '\n'
+        if self.cpu_bound:
+            return await super().run()
+        return await asyncio.to_thread(self.compute, *self.compute_args())
+
+    def compute_args(self):
+        return (self.source, self.target, self.data)
+
+    @staticmethod
+    def compute(source, target, data):
+        template = jinja2_env.get_template(str(source))
+        output = template.render(**data) + '\n'
 
+        # Leave the output untouched if it didn't change, so dependents don't need to look at it again.
+        try:
+            if target.read_text() == output:
+                return
+        except FileNotFoundError:
+            pass
 
         # Ensure output directory exists.
-        self.target.parent.mkdir(parents = True, exist_ok = True)
+        target.parent.mkdir(parents = True, exist_ok = True)
 
-        with open(self.target, 'w') as f:
+        with open(target, 'w') as f:
             f.write(output)
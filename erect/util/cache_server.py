@@ -0,0 +1,78 @@
+'''Reference server for the remote artifact cache protocol.
+
+Artifacts are stored as files named by their key, `GET /<key>` returns one (or 404) and `PUT /<key>` stores one.
+Run it with `python -m erect.util.cache_server`.
+'''
+
+import http.server
+import pathlib
+import re
+import tempfile
+
+import click
+
+_key_re = re.compile(r'/([0-9a-f]{40})')
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    root: pathlib.Path
+
+    def _path(self):
+        m = _key_re.fullmatch(self.path)
+        if m is None:
+            self.send_error(400)
+            return None
+        key = m.group(1)
+        return self.root / key[:2] / key
+
+    def do_GET(self):
+        path = self._path()
+        if path is None:
+            return
+
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-tar')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        path = self._path()
+        if path is None:
+            return
+
+        if 'Content-Length' not in self.headers:
+            self.send_error(411)
+            return
+
+        data = self.rfile.read(int(self.headers['Content-Length']))
+
+        # Write to a temporary file first, so concurrent readers never see partial artifacts.
+        path.parent.mkdir(parents = True, exist_ok = True)
+        with tempfile.NamedTemporaryFile(dir = path.parent, delete = False) as f:
+            f.write(data)
+        pathlib.Path(f.name).replace(path)
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+def serve(root, host = 'localhost', port = 8080):
+    handler = type('Handler', (Handler,), {'root': pathlib.Path(root)})
+    with http.server.ThreadingHTTPServer((host, port), handler) as server:
+        server.serve_forever()
+
+@click.command()
+@click.argument('root', type = click.Path(file_okay = False, path_type = pathlib.Path))
+@click.option('--host', default = 'localhost', help = 'Address to listen on.')
+@click.option('--port', default = 8080, help = 'Port to listen on.')
+def main(root, host, port):
+    serve(root, host, port)
+
+if __name__ == '__main__':
+    main()
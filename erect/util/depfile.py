@@ -0,0 +1,106 @@
+'''Parser for Makefile style dependency files, as written by `gcc -MD`.'''
+
+__all__ = ['parse_depfile']
+
+def _logical_lines(f):
+    'Join lines continued with a trailing backslash.'
+
+    parts = []
+    for line in f:
+        line = line.rstrip('\r\n')
+
+        # An odd number of trailing backslashes ends with an unescaped one.
+        if (len(line) - len(line.rstrip('\\'))) % 2:
+            parts.append(line[:-1])
+            continue
+        parts.append(line)
+        yield ' '.join(parts)
+        parts = []
+
+    if parts:
+        yield ' '.join(parts)
+
+def _tokens(line):
+    '''Split a line into file names, with None marking the separator between targets and prerequisites.
+
+    Whitespace and `#` are escaped with a backslash and `$` is doubled, other backslashes are taken literally, to support Windows paths.
+    A colon only separates when followed by whitespace or the end of the line, so drive letters aren't mistaken for it.
+    '''
+
+    token = []
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+
+        if c == '\\' and i + 1 < n and line[i + 1] in ' \t#\\':
+            # A run of backslashes before whitespace is halved, and the whitespace escaped if it was odd.
+            if line[i + 1] == '\\':
+                j = i
+                while j < n and line[j] == '\\':
+                    j += 1
+                count = j - i
+                if j < n and line[j] in ' \t':
+                    token.append('\\' * (count // 2))
+                    if count % 2:
+                        token.append(line[j])
+                        j += 1
+                else:
+                    token.append('\\' * count)
+                i = j
+                continue
+
+            token.append(line[i + 1])
+            i += 2
+            continue
+
+        if c == '$' and i + 1 < n and line[i + 1] == '$':
+            token.append('$')
+            i += 2
+            continue
+
+        if c in ' \t':
+            if token:
+                yield ''.join(token)
+                token = []
+            i += 1
+            continue
+
+        if c == ':' and (i + 1 == n or line[i + 1] in ' \t'):
+            if token:
+                yield ''.join(token)
+                token = []
+            yield None
+            i += 1
+            continue
+
+        token.append(c)
+        i += 1
+
+    if token:
+        yield ''.join(token)
+
+def parse_depfile(f):
+    '''Parse dependency rules from the lines of `f`, a text file or any iterable of lines.
+
+    Yields a tuple of targets and prerequisites for each rule, with order-only prerequisites left out.
+    Lines are processed one at a time, so the whole file is never held in memory.
+    '''
+
+    for line in _logical_lines(f):
+        tokens = list(_tokens(line))
+        if None not in tokens:
+            continue
+
+        separator = tokens.index(None)
+        targets = tokens[:separator]
+
+        prerequisites = []
+        for token in tokens[separator + 1:]:
+            # Everything after a | is order-only.
+            if token == '|':
+                break
+            if token is not None:
+                prerequisites.append(token)
+
+        yield targets, prerequisites
@@ -0,0 +1,128 @@
+import asyncio
+import concurrent.futures
+import os
+import re
+
+__all__ = ['Jobserver']
+
+_jobs_re = re.compile(r'(?:^|\s)-j(\d+)')
+_auth_re = re.compile(r'--jobserver-(?:auth|fds)=(?:fifo:(?P<fifo>\S+)|(?P<read>\d+),(?P<write>\d+))')
+
+class Jobserver:
+    '''GNU make jobserver.
+
+    Every participant has one implicit job slot, and must read a token from the jobserver before running any additional jobs.
+    Tokens are written back when the jobs finish.
+    '''
+
+    def __init__(self, read_fd, write_fd, *, makeflags, fifo = None, owner = False):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.makeflags = makeflags
+        self.fifo = fifo
+        self.owner = owner
+
+        # Reopening the pipe through /proc gives us a file description of our own, that can be made non-blocking without affecting other processes.
+        # If that's not possible, blocking reads are done in a dedicated thread.
+        self._reader_fd = None
+        if fifo is None:
+            try:
+                self._reader_fd = os.open(f'/proc/self/fd/{read_fd}', os.O_RDONLY | os.O_NONBLOCK)
+            except OSError:
+                pass
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'erect-jobserver')
+
+    @classmethod
+    def from_environ(cls, environ = os.environ):
+        'Connect to the jobserver of a parent make, if any.'
+
+        makeflags = environ.get('MAKEFLAGS', '')
+
+        # The last option takes precedence if there are several.
+        matches = list(_auth_re.finditer(makeflags))
+        if not matches:
+            return None
+        m = matches[-1]
+
+        if m['fifo']:
+            read_fd = os.open(m['fifo'], os.O_RDONLY | os.O_NONBLOCK)
+            write_fd = os.open(m['fifo'], os.O_WRONLY)
+            return cls(read_fd, write_fd, makeflags = makeflags, fifo = m['fifo'])
+
+        read_fd, write_fd = int(m['read']), int(m['write'])
+        try:
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except OSError:
+            # Make didn't pass the descriptors on, e.g. because the recipe wasn't marked with +.
+            return None
+
+        return cls(read_fd, write_fd, makeflags = makeflags)
+
+    @classmethod
+    def create(cls, jobs):
+        'Create a jobserver with `jobs` slots, one of which is the implicit slot of the creator.'
+
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'+' * (jobs - 1))
+
+        return cls(read_fd, write_fd, makeflags = f' -j{jobs} --jobserver-auth={read_fd},{write_fd}', owner = True)
+
+    @property
+    def jobs(self):
+        'Total number of job slots, if known.'
+
+        m = _jobs_re.search(self.makeflags)
+        return m and int(m[1])
+
+    @property
+    def pass_fds(self):
+        'File descriptors child processes must inherit to participate.'
+
+        return () if self.fifo else (self.read_fd, self.write_fd)
+
+    def environ(self):
+        'Environment variables for child processes.'
+
+        return {'MAKEFLAGS': self.makeflags}
+
+    async def acquire(self):
+        'Read a token from the jobserver.'
+
+        loop = asyncio.get_running_loop()
+
+        fd = self._reader_fd if self._reader_fd is not None else self.read_fd
+        if not os.get_blocking(fd):
+            while True:
+                try:
+                    return os.read(fd, 1)
+                except BlockingIOError:
+                    readable = loop.create_future()
+                    loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+                    try:
+                        await readable
+                    finally:
+                        loop.remove_reader(fd)
+
+        future = loop.run_in_executor(self._executor, os.read, self.read_fd, 1)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The read can't be interrupted, so give back the token if it arrives after all.
+            future.add_done_callback(lambda f: f.exception() is None and self.release(f.result()))
+            raise
+
+    def release(self, token):
+        'Return a token to the jobserver.'
+
+        os.write(self.write_fd, token)
+
+    def close(self):
+        self._executor.shutdown(wait = False, cancel_futures = True)
+
+        if self._reader_fd is not None:
+            os.close(self._reader_fd)
+
+        if self.owner or self.fifo:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
@@ -0,0 +1,132 @@
+'''Remote execution of commands on worker daemons, see `erect.util.worker`.
+
+Messages are a length prefixed JSON header, followed by the contents of the files it lists.
+'''
+
+import asyncio
+import json
+import pathlib
+import sys
+
+__all__ = ['RemoteExecutor']
+
+MAX_HEADER_SIZE = 1024 * 1024
+
+async def read_message(reader):
+    size = int.from_bytes(await reader.readexactly(4), 'big')
+    if size > MAX_HEADER_SIZE:
+        raise ValueError(f'Message header of {size} bytes is too large')
+
+    header = json.loads(await reader.readexactly(size))
+    files = {}
+    for name, length in header.pop('files', []):
+        files[name] = await reader.readexactly(length)
+
+    return header, files
+
+def write_message(writer, header, files = {}):
+    data = json.dumps(header | {'files': [[name, len(content)] for name, content in files.items()]}).encode('utf-8')
+    writer.write(len(data).to_bytes(4, 'big') + data)
+    for content in files.values():
+        writer.write(content)
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host.strip('[]') or 'localhost', int(port)
+
+class RemoteWorker:
+    def __init__(self, address):
+        self.address = address
+        self.host, self.port = parse_address(address)
+        self.jobs = 0
+        self.active = 0
+
+class RemoteExecutor:
+    '''Runs commands on remote workers.
+
+    Input files are sent along with the command line, and output files are brought back, so commands must not use any other files.
+    Each worker runs as many commands at a time as it reports job slots, and commands go to the least loaded worker.
+    Commands that can't be run remotely, e.g. because a worker can't be reached, are left to the caller to run locally.
+    '''
+
+    def __init__(self, addresses, *, timeout = 300):
+        self.workers = [RemoteWorker(address) for address in addresses]
+        self.timeout = timeout
+        self._slots = None
+
+        self.jobs = 0
+        self.failures = 0
+
+    @property
+    def capacity(self):
+        return sum(worker.jobs for worker in self.workers)
+
+    async def _request(self, worker, header, files = {}):
+        reader, writer = await asyncio.open_connection(worker.host, worker.port)
+        try:
+            write_message(writer, header, files)
+            await writer.drain()
+            return await read_message(reader)
+        finally:
+            writer.close()
+
+    async def start(self):
+        'Ask all workers for their number of job slots, and drop the ones that don\'t answer.'
+
+        async def hello(worker):
+            try:
+                header, _ = await asyncio.wait_for(self._request(worker, {'hello': 1}), 10)
+                worker.jobs = int(header['jobs'])
+            except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                print(f'Remote worker {worker.address} unavailable: {e}', file = sys.stderr)
+
+        await asyncio.gather(*(hello(worker) for worker in self.workers))
+        self.workers = [worker for worker in self.workers if worker.jobs > 0]
+        self._slots = asyncio.Semaphore(self.capacity)
+
+    async def run(self, cmd, inputs, outputs):
+        '''Run `cmd` on a worker, with `inputs` available and `outputs` brought back.
+
+        Returns a tuple of return code, stdout and stderr, or None if the command wasn't run.
+        '''
+
+        if not self.capacity:
+            return None
+
+        inputs = [pathlib.Path(path) for path in inputs]
+        outputs = [pathlib.Path(path) for path in outputs]
+
+        # Files get plain names on the worker, keeping suffixes since tools look at them.
+        names = {str(path): f'in{i}{path.suffix}' for i, path in enumerate(inputs)}
+        names |= {str(path): f'out{i}{path.suffix}' for i, path in enumerate(outputs)}
+        argv = [names.get(str(e), str(e)) for e in cmd]
+
+        async with self._slots:
+            worker = min(self.workers, key = lambda worker: worker.active / worker.jobs)
+            worker.active += 1
+            try:
+                contents = await asyncio.gather(*(asyncio.to_thread(path.read_bytes) for path in inputs))
+                header, files = await asyncio.wait_for(self._request(worker, {
+                    'argv': argv,
+                    'outputs': [names[str(path)] for path in outputs],
+                }, {names[str(path)]: content for path, content in zip(inputs, contents)}), self.timeout)
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                self.failures += 1
+                return None
+            finally:
+                worker.active -= 1
+
+        if 'error' in header:
+            print(f'Remote worker {worker.address}: {header["error"]}', file = sys.stderr)
+            self.failures += 1
+            return None
+
+        if header['returncode'] == 0:
+            for path in outputs:
+                content = files.get(names[str(path)])
+                if content is None:
+                    raise RuntimeError(f'Remote worker {worker.address} didn\'t produce {path}')
+                await asyncio.to_thread(path.write_bytes, content)
+
+        self.jobs += 1
+        return header['returncode'], header['stdout'], header['stderr']
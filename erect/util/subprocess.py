@@ -1,18 +1,115 @@
 import asyncio
+import contextlib
+import os
 import shlex
+import sys
+from subprocess import Popen
+
+from ..core.task import current_task
+
+async def _wait(process):
+    '''Wait for `process` to exit and reap it with `os.wait4()`, returning its exit code and resource usage.
+
+    The process must not be known to asyncio's child watcher, which would reap it first.
+    A pidfd is used to wait without blocking where available, a thread otherwise.
+    '''
 
-async def subprocess(cmd, *, stdout = None, stderr = None):
-    print(shlex.join(str(e) for e in cmd))
-    process = await asyncio.create_subprocess_exec(
-        *(str(e) for e in cmd),
-        stdout = stdout,
-        stderr = stderr,
-    )
     try:
-        code = await process.wait()
-        if code != 0:
-            raise RuntimeError(f'Process returned {code}')
-    finally:
-        if process.returncode is None:
-            process.terminate()
-            await process.wait()
+        pidfd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        _, status, rusage = await asyncio.to_thread(os.wait4, process.pid, 0)
+    else:
+        try:
+            loop = asyncio.get_running_loop()
+            exited = loop.create_future()
+            loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+            try:
+                await exited
+            finally:
+                loop.remove_reader(pidfd)
+        finally:
+            os.close(pidfd)
+        _, status, rusage = os.wait4(process.pid, 0)
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage
+
+async def subprocess(cmd, *, stdout = None, stderr = None, inputs = (), outputs = (), remote = False):
+    '''Run `cmd`, raising RuntimeError if it fails.
+
+    The resource usage of local commands is added to the current task's `resources`.
+    With `remote` set, the command may run on a remote worker if any are configured.
+    It must then only read `inputs` and write `outputs`, and its output is printed rather than redirected to `stdout` and `stderr`.
+    '''
+
+    print(shlex.join(str(e) for e in cmd))
+
+    task = current_task.get()
+    name = os.path.basename(str(cmd[0]))
+    def trace(cat):
+        return task._trace(name, cat) if task else contextlib.nullcontext()
+
+    executor = remote and task and task.ctx.remote_executor
+    if executor:
+        # The task slot isn't needed while the command runs elsewhere.
+        async with task.mark_suspended():
+            with trace('remote'):
+                result = await executor.run(cmd, inputs, outputs)
+
+        if result is not None:
+            code, out, err = result
+            sys.stdout.write(out)
+            sys.stderr.write(err)
+            if code != 0:
+                raise RuntimeError(f'Process returned {code}')
+            return
+
+    # Let children such as make or gcc -flto=jobserver share our job slots.
+    jobserver = task and task.ctx.jobserver
+    if jobserver:
+        env = os.environ | jobserver.environ()
+        pass_fds = jobserver.pass_fds
+    else:
+        env = None
+        pass_fds = ()
+
+    if not hasattr(os, 'wait4'):
+        with trace('subprocess'):
+            process = await asyncio.create_subprocess_exec(
+                *(str(e) for e in cmd),
+                stdout = stdout,
+                stderr = stderr,
+                env = env,
+                pass_fds = pass_fds,
+            )
+            try:
+                code = await process.wait()
+                if code != 0:
+                    raise RuntimeError(f'Process returned {code}')
+            finally:
+                if process.returncode is None:
+                    process.terminate()
+                    await process.wait()
+        return
+
+    with trace('subprocess') as args:
+        # Started without asyncio, so the process is left for us to reap along with its resource usage.
+        process = Popen(
+            [str(e) for e in cmd],
+            stdout = stdout,
+            stderr = stderr,
+            env = env,
+            pass_fds = pass_fds,
+        )
+        try:
+            code, rusage = await _wait(process)
+            if task:
+                task.add_resource_usage(rusage)
+            if args is not None:
+                args.update(user = rusage.ru_utime, system = rusage.ru_stime, max_rss_kb = rusage.ru_maxrss, code = code)
+            if code != 0:
+                raise RuntimeError(f'Process returned {code}')
+        finally:
+            if process.returncode is None:
+                process.terminate()
+                await _wait(process)
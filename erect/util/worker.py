@@ -0,0 +1,118 @@
+'''Reference worker daemon for remote execution.
+
+Each request is a command line and its input files, which are written to a temporary directory before running the command in it.
+The exit code, output and requested output files are sent back.
+Only compilers are allowed to run, by name or absolute path on the worker, without options that run other programs, read files the client names or write files other than the requested outputs.
+This is a safeguard against mistakes rather than a sandbox, compilers have a large attack surface, so only accept connections from trusted clients.
+Run it with `python -m erect.util.worker`.
+'''
+
+import asyncio
+import os
+import pathlib
+import re
+import sys
+import tempfile
+
+import click
+
+from .remote import read_message, write_message
+
+_compiler_re = re.compile(r'(?:.+-)?(?:gcc|g\+\+|cc|c\+\+|clang|clang\+\+)(?:-[\d.]+)?')
+_name_re = re.compile(r'[\w+-][\w.+-]*')
+
+# Prefixes of options that run other programs, read files outside the working directory or write files other than `-o`.
+_denied_options = (
+    '@', '-B', '-wrapper', '-fplugin', '-specs', '--specs', '-o', '-M', '-i', '-I', '-L', '-l', '-T', '--sysroot',
+    '-Wa,', '-Wl,', '-Wp,', '-Xassembler', '-Xlinker', '-Xpreprocessor',
+    '-save-temps', '-dump', '-fdump-', '-fprofile', '-fopt-info', '-fcallgraph-info', '-fstack-usage', '--coverage', '-ftest-coverage',
+)
+
+def _check_argv(argv, outputs):
+    'Return why `argv` isn\'t allowed to run, or None if it is.'
+
+    # Relative paths with directories would be resolved in the working directory, where the client's files are.
+    if not argv or not (os.path.isabs(argv[0]) or argv[0] == os.path.basename(argv[0])) or not _compiler_re.fullmatch(os.path.basename(argv[0])):
+        return f'Not allowed to run {argv[:1]}'
+
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == '-o':
+            output = next(args, None)
+            if output not in outputs:
+                return f'Output {output!r} wasn\'t requested'
+        elif arg.startswith(_denied_options):
+            return f'Option {arg!r} isn\'t allowed'
+        elif any(os.path.isabs(part) or '..' in pathlib.PurePath(part).parts for part in arg.split('=')):
+            return f'Argument {arg!r} refers to files outside the working directory'
+
+    return None
+
+class Worker:
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.slots = asyncio.Semaphore(jobs)
+
+    async def handle(self, reader, writer):
+        try:
+            header, files = await read_message(reader)
+            if 'hello' in header:
+                write_message(writer, {'jobs': self.jobs})
+            else:
+                write_message(writer, *await self.run(header['argv'], header['outputs'], files))
+            await writer.drain()
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, argv, outputs, files):
+        names = [*files, *outputs]
+        if not all(_name_re.fullmatch(name) for name in names):
+            return {'error': 'Invalid file name'}, {}
+
+        if error := _check_argv(argv, outputs):
+            print(error, file = sys.stderr)
+            return {'error': error}, {}
+
+        async with self.slots:
+            with tempfile.TemporaryDirectory(prefix = 'erect-worker-') as tmp:
+                tmp = pathlib.Path(tmp)
+                for name, content in files.items():
+                    (tmp / name).write_bytes(content)
+
+                process = await asyncio.create_subprocess_exec(
+                    *argv,
+                    cwd = tmp,
+                    stdin = asyncio.subprocess.DEVNULL,
+                    stdout = asyncio.subprocess.PIPE,
+                    stderr = asyncio.subprocess.PIPE,
+                )
+                stdout, stderr = await process.communicate()
+
+                results = {}
+                if process.returncode == 0:
+                    results = {name: (tmp / name).read_bytes() for name in outputs if (tmp / name).is_file()}
+
+        return {
+            'returncode': process.returncode,
+            'stdout': stdout.decode('utf-8', 'replace'),
+            'stderr': stderr.decode('utf-8', 'replace'),
+        }, results
+
+async def serve(host = 'localhost', port = 3633, jobs = None):
+    worker = Worker(jobs or os.cpu_count())
+    server = await asyncio.start_server(worker.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+@click.command()
+@click.option('--host', default = 'localhost', help = 'Address to listen on.')
+@click.option('--port', default = 3633, help = 'Port to listen on.')
+@click.option('-j', '--jobs', type = int, help = 'Max parallel commands, defaults to the number of CPUs.')
+def main(host, port, jobs):
+    print(f'Serving on {host}:{port}, only accept connections from trusted clients.', file = sys.stderr)
+    asyncio.run(serve(host, port, jobs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+import pytest
+
+from erect.core import Context, Task
+
+class Write(Task):
+    artifact_cacheable = True
+
+    def __new__(cls, ctx, root, content = 'out'):
+        self = super().__new__(cls, ctx, ('write', root))
+        self.root = root
+        self.content = content
+        self.output = root / 'build' / 'out.txt'
+        self.add_output_files(self.output)
+        return self
+
+    def artifact_root(self):
+        return self.root / 'build'
+
+    async def run(self):
+        self.output.parent.mkdir(exist_ok = True)
+        self.output.write_text(self.content)
+
+def build(root, store, content = 'out'):
+    with Context(cache_file = False, artifact_cache = store) as ctx:
+        asyncio.run(ctx.run([Write(ctx, root, content)]))
+        return ctx.artifacts.hits if ctx.artifacts else 0
+
+@pytest.mark.parametrize('path', [
+    [False, '{outside}'],
+    [True, '{outside}'],
+    [True, '../../outside.txt'],
+])
+def test_restore_outside_outputs(tmp_path, path):
+    store = tmp_path / 'store'
+    outside = tmp_path / 'outside.txt'
+
+    assert build(tmp_path, store) == 0
+    assert build(tmp_path, store) == 1
+
+    manifest_file, = store.glob('*/*/manifest.json')
+    manifest = json.loads(manifest_file.read_text())
+    manifest['outputs'] = [[path[0], path[1].format(outside = outside)]]
+    manifest_file.write_text(json.dumps(manifest))
+
+    assert build(tmp_path, store) == 0
+    assert not outside.exists()
+
+def test_rebuild_after_restore_keeps_store(tmp_path):
+    store = tmp_path / 'store'
+
+    assert build(tmp_path, store) == 0
+    assert build(tmp_path, store) == 1
+
+    # Without the store, the task writes its output in place.
+    build(tmp_path, None, content = 'changed')
+    assert (tmp_path / 'build' / 'out.txt').read_text() == 'changed'
+
+    stored_file, = store.glob('*/*/files/0')
+    assert stored_file.read_text() == 'out'
@@ -0,0 +1,119 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+from erect.core.cache import SQLiteCache, metadata_digest
+from erect.core.file import Fingerprint
+
+def fingerprint_count(cache):
+    count, = cache.db.execute('SELECT count(*) FROM fingerprints').fetchone()
+    return count
+
+def write_build(filename, build, max_size = None, tasks = 100):
+    'Open the cache and write entries as a build where every input changed would.'
+
+    cache = SQLiteCache(filename, max_size = max_size)
+    for i in range(tasks):
+        cache[f'task {i}'] = {'file_fingerprints': {
+            pathlib.Path(f'src/{i}/{j}.h'): Fingerprint(build, build.to_bytes(32, 'little'), 'sha256') for j in range(10)
+        }}
+    cache.close()
+
+def test_unreferenced_fingerprints_removed(tmp_path):
+    for build in range(5):
+        write_build(tmp_path / 'cache.sqlite', build)
+
+    cache = SQLiteCache(tmp_path / 'cache.sqlite')
+    assert fingerprint_count(cache) <= 1000 * 1.5
+    assert len(cache['task 0']['file_fingerprints']) == 10
+
+def test_max_size_counts_fingerprints(tmp_path):
+    for build in range(5):
+        write_build(tmp_path / 'cache.sqlite', build, max_size = 16 * 1024)
+
+    cache = SQLiteCache(tmp_path / 'cache.sqlite')
+    entries_size, = cache.db.execute('SELECT sum(length(entry)) FROM tasks').fetchone()
+    fingerprints_size = sum(cache._fingerprint_sizes().values())
+    assert 0 < len(cache) < 100
+    assert entries_size + fingerprints_size <= 16 * 1024
+
+def test_gc_keep_generations(tmp_path):
+    filename = tmp_path / 'cache.sqlite'
+    for build in range(3):
+        cache = SQLiteCache(filename)
+        cache[f'build {build}'] = {}
+        cache.close()
+
+    # Opened for maintenance only, like `--cache-gc`.
+    cache = SQLiteCache(filename)
+    assert cache.gc([], keep_generations = 1) == 2
+    assert 'build 2' in cache
+    assert cache.gc([], keep_generations = 0) == 1
+    assert len(cache) == 0
+
+def entry(build, files = 10):
+    return {'file_fingerprints': {
+        pathlib.Path(f'src/{j}.h'): Fingerprint(build, build.to_bytes(32, 'little'), 'sha256') for j in range(files)
+    }}
+
+def test_shared_evict(tmp_path):
+    # Each instance evicts knowing fingerprints only the other one added.
+    a = SQLiteCache(tmp_path / 'cache.sqlite', max_size = 2048)
+    b = SQLiteCache(tmp_path / 'cache.sqlite', max_size = 2048)
+    for build in range(5):
+        a[f'a {build}'] = entry(build)
+        a.flush()
+        b[f'b {build}'] = entry(build + 100)
+        b.flush()
+    a.close()
+    b.close()
+
+def test_shared_remove_unreferenced(tmp_path):
+    filename = tmp_path / 'cache.sqlite'
+    write_build(filename, 0)
+
+    a = SQLiteCache(filename)
+    b = SQLiteCache(filename)
+
+    # Every fingerprint of build 0 becomes unreferenced, while `b` still knows them.
+    write_build(filename, 1)
+    a['task 0'] = entry(2)
+    a.flush()
+
+    b['other'] = {'file_fingerprints': {pathlib.Path('src/0/0.h'): Fingerprint(0, (0).to_bytes(32, 'little'), 'sha256')}}
+    b.close()
+    a.close()
+
+    cache = SQLiteCache(filename)
+    assert len(cache['other']['file_fingerprints']) == 1
+    for key in list(cache._raw):
+        cache[key]
+
+def test_removed_fingerprint_is_miss(tmp_path):
+    filename = tmp_path / 'cache.sqlite'
+    cache = SQLiteCache(filename)
+    cache['task'] = entry(0)
+    cache.flush()
+
+    # As if removed by another process before the entry was loaded.
+    with cache.db:
+        cache.db.execute('DELETE FROM fingerprints WHERE id = (SELECT min(id) FROM fingerprints)')
+    cache.db.close()
+
+    cache = SQLiteCache(filename)
+    assert 'task' not in cache
+    assert cache.get('task') is None
+
+def test_metadata_digest_canonical():
+    # String hashes, and so the order of sets of strings, change with the hash seed of each process.
+    code = 'from erect.core.cache import metadata_digest; print(metadata_digest({"defines": {f"D{i}" for i in range(100)}}).hex())'
+    digests = {
+        subprocess.run([sys.executable, '-c', code], env = os.environ | {'PYTHONHASHSEED': str(seed)}, cwd = pathlib.Path(__file__).parent.parent, capture_output = True, text = True, check = True).stdout
+        for seed in range(3)
+    }
+    assert len(digests) == 1
+
+    assert metadata_digest({'a': 1, 'b': 2}) == metadata_digest({'b': 2, 'a': 1})
+    assert metadata_digest({'a': 1}) != metadata_digest({'a': True})
+    assert metadata_digest({'a': pathlib.Path('x')}) != metadata_digest({'a': 'x'})
@@ -0,0 +1,58 @@
+import asyncio
+import os
+import pathlib
+import socket
+
+import pytest
+
+from erect.core import Context
+from erect.lib.gcc import Env, _unity_batches
+from erect.lib.gcc.module_mapper import ModuleMapper
+
+@pytest.mark.parametrize('header', ['hal.h', '{cwd}/hal.h', '{cwd}/../hal.h', '../hal.h'])
+def test_precompiled_header_path(tmp_path, monkeypatch, header):
+    (tmp_path / 'src').mkdir()
+    monkeypatch.chdir(tmp_path / 'src')
+    header = header.format(cwd = os.getcwd())
+
+    with Context(cache_file = False) as ctx:
+        task = Env(ctx = ctx).precompiled_header(header)
+
+    # The forwarding header must not be the header itself.
+    pch_dir = tmp_path / 'src' / 'build' / 'pch'
+    assert task.include_file.resolve().is_relative_to(pch_dir)
+    assert task.gch_file.resolve().is_relative_to(pch_dir)
+    assert task.include_file.resolve() != pathlib.Path(header).resolve()
+
+def test_unity_batches_stable():
+    sources = [pathlib.Path(f'src/{i}.cpp') for i in range(40)]
+    before = dict(_unity_batches(sources, 8))
+    after = dict(_unity_batches(sources + [pathlib.Path('src/new.cpp')], 8))
+
+    assert sum(len(batch) for batch in before.values()) == 40
+    changed = [name for name in before.keys() | after.keys() if before.get(name) != after.get(name)]
+    assert len(changed) == 1
+
+def test_unity_object_path(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    with Context(cache_file = False) as ctx:
+        env = Env(ctx = ctx)
+        link = env.executable('app', ['src/a.cpp', 'src/b.cpp'], unity = 'directory')
+
+    object_file, = (task.object_file for task in link.object_tasks)
+    assert object_file == pathlib.Path('build/unity/app/src/unity0.o')
+
+@pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason = 'needs Unix domain sockets')
+def test_module_mapper_stop_removes_socket(tmp_path):
+    async def start_stop(mapper):
+        await mapper.start()
+        socket_dir = mapper.socket_path.parent
+        assert mapper.socket_path.exists()
+        await mapper.stop()
+        return socket_dir
+
+    with Context(cache_file = False) as ctx:
+        socket_dir = asyncio.run(start_stop(ModuleMapper(Env(ctx = ctx), tmp_path / 'cmi')))
+
+    assert not socket_dir.exists()
@@ -0,0 +1,15 @@
+import asyncio
+
+from erect.core import Context
+from erect.lib.jinja2 import Env, Jinja2, jinja2_env
+
+def test_custom_filter(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(jinja2_env.filters, 'shout', str.upper)
+    (tmp_path / 'hello.txt.j2').write_text('hello {{ name | shout }}!')
+
+    with Context(cache_file = False) as ctx:
+        task = Jinja2(Env(ctx = ctx), 'hello.txt', 'hello.txt.j2', name = 'world')
+        asyncio.run(ctx.run([task]))
+
+    assert (tmp_path / 'build' / 'generated' / 'hello.txt').read_text() == 'hello WORLD!\n'
@@ -0,0 +1,79 @@
+import asyncio
+import os
+
+import pytest
+
+from erect.core import Context, DeadlockError, Task
+from erect.util.load import load_blueprint
+
+class Write(Task):
+    def __new__(cls, ctx, output, input):
+        self = super().__new__(cls, ctx, ('write', output))
+        self.output = output
+        self.add_input_files(input)
+        self.add_output_files(output)
+        return self
+
+    async def run(self):
+        self.output.write_text(self.id.str)
+
+@pytest.mark.parametrize('critical_path', [False, True])
+def test_dependency_cycle(tmp_path, critical_path):
+    with Context(cache_file = False, critical_path = critical_path) as ctx:
+        a = Write(ctx, tmp_path / 'a.txt', tmp_path / 'b.txt')
+        b = Write(ctx, tmp_path / 'b.txt', tmp_path / 'a.txt')
+
+        with pytest.raises(DeadlockError, match = 'Dependency cycle: '):
+            asyncio.run(asyncio.wait_for(ctx.run([a, b]), timeout = 10))
+
+@pytest.mark.parametrize('jobserver, parent, expected', [
+    (None, False, None),
+    (None, True, 'parent'),
+    (True, False, 'own'),
+    (True, True, 'parent'),
+    (False, True, None),
+])
+def test_jobserver_mode(monkeypatch, jobserver, parent, expected):
+    read_fd, write_fd = os.pipe()
+    try:
+        if parent:
+            monkeypatch.setenv('MAKEFLAGS', f' -j4 --jobserver-auth={read_fd},{write_fd}')
+        else:
+            monkeypatch.delenv('MAKEFLAGS', raising = False)
+
+        with Context(cache_file = False, jobserver = jobserver) as ctx:
+            if expected is None:
+                assert ctx.jobserver is None
+            else:
+                assert ctx.jobserver is not None
+                assert ctx.jobserver.owner == (expected == 'own')
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+BLUEPRINT = '''
+import os
+
+from erect.core import Task
+
+class Compute(Task):
+    cpu_bound = True
+
+    def __new__(cls, ctx):
+        return super().__new__(cls, ctx, ('compute',))
+
+    @staticmethod
+    def compute():
+        return os.getpid()
+'''
+
+def test_cpu_bound_in_blueprint(tmp_path):
+    # Workers can't import classes defined in the blueprint, so they run in a thread.
+    (tmp_path / 'blueprint.py').write_text(BLUEPRINT)
+    blueprint = load_blueprint(tmp_path / 'blueprint.py')
+
+    with Context(cache_file = False) as ctx:
+        task = blueprint.Compute(ctx)
+        asyncio.run(ctx.run([task]))
+
+    assert task.result == os.getpid()
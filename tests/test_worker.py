@@ -0,0 +1,31 @@
+import pytest
+
+from erect.util.worker import _check_argv
+
+OUTPUTS = ['out0.o']
+
+@pytest.mark.parametrize('argv', [
+    ['g++', '-O2', '-c', 'in0.ii', '-o', 'out0.o'],
+    ['arm-none-eabi-gcc-12', '-std=c++20', '-c', 'in0.i', '-o', 'out0.o'],
+    ['/usr/bin/g++', '-c', 'in0.ii', '-o', 'out0.o'],
+])
+def test_allowed(argv):
+    assert _check_argv(argv, OUTPUTS) is None
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['sh', '-c', 'true'],
+    ['bin/gcc', '-c', 'in0.ii'],
+    ['/bin/sh', '-c', 'true'],
+    ['g++', '-wrapper', 'sh,-c,true', '-c', 'in0.ii'],
+    ['g++', '-fplugin=./plugin.so', '-c', 'in0.ii'],
+    ['g++', '-B', 'bin', '-c', 'in0.ii'],
+    ['g++', '@args'],
+    ['g++', '-c', 'in0.ii', '-o', '/tmp/out.o'],
+    ['g++', '-c', 'in0.ii', '-o', 'other.o'],
+    ['g++', '-c', 'in0.ii', '-oout0.o'],
+    ['g++', '-c', '../in0.ii', '-o', 'out0.o'],
+    ['g++', '-fdiagnostics-set-output=text:file=/tmp/log', '-c', 'in0.ii'],
+])
+def test_denied(argv):
+    assert _check_argv(argv, OUTPUTS) is not None